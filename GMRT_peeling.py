@@ -17,18 +17,178 @@
 
 import numpy as np
 
-def extrModel(modelimg, region, compl=False, extend=None):
-    """Extract only the part described by the region file
-    from one or more (nterms>1) model img
+# cache of the rasterized regions: {_regionKey(): (mask, bbox)}
+_regionMaskCache = {}
+# result of checkRegionMask(): {_regionKey(): bool}
+_regionMaskChecked = {}
+
+def _crtfList(text):
+    """Parse the "[[a, b], [c, d], e]" part of a CRTF line into nested lists of strings
+    """
+    import re
+    stack = [[]]
+    for tok in re.findall(r'\[|\]|[^,\[\]\s]+', text):
+        if tok == '[':
+            stack.append([])
+        elif tok == ']':
+            l = stack.pop()
+            stack[-1].append(l)
+            if len(stack) == 1: break
+        else: stack[-1].append(tok)
+    return stack[0][0]
+
+def _parseCRTF(region):
+    """Return the shapes of a CRTF region file as a list of (include, shape, params),
+    None if it has shapes or frames not supported by _regionMask()
+    """
+    shapes = []
+    with open(region) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#') or line.startswith('global') or line.startswith('ann'): continue
+            include = not line.startswith('-')
+            line = line.lstrip('+-')
+            shape = line.split('[')[0].strip()
+            if not shape in ['ellipse', 'circle', 'box', 'centerbox', 'rotbox', 'poly']: return None
+            if 'coord=' in line and not line.split('coord=')[1].split(',')[0].strip() in ['J2000', 'ICRS']: return None
+            shapes.append((include, shape, _crtfList(line[line.index('['):])))
+    return shapes
+
+def _inPoly(x, y, px, py):
+    """Pixels (x, y grids) inside the polygon of vertices px, py (even-odd rule)
+    """
+    inside = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+    j = len(px)-1
+    for i in xrange(len(px)):
+        if py[i] != py[j]:
+            cross = (py[i] > y) != (py[j] > y)
+            inside ^= cross & (x < (px[j]-px[i])*(y-py[i])/(py[j]-py[i]) + px[i])
+        j = i
+    return inside
+
+def _regionKey(region, csys, shape, extend=None):
+    """Key of the region caches: the region file and the geometry of the image
+    """
+    return (os.path.abspath(region), os.path.getmtime(region), repr(extend), tuple(shape[0:2]), \
+        repr(list(csys.referencevalue()['numeric'][0:2])), repr(list(csys.referencepixel()['numeric'][0:2])), \
+        repr(list(csys.increment()['numeric'][0:2])))
+
+def _regionMask(region, csys, shape, extend=None):
+    """Return the boolean (x, y) mask of the pixels of an image inside a CRTF region
+    and its bounding box (blc, trc), None if the region is not supported
+    extend: [ra, dec], add a 900 arcsec ellipse centred there to the region
+    """
+    increment = csys.increment()['numeric']
+    units = csys.units()
+    key = _regionKey(region, csys, shape, extend)
+    if key in _regionMaskCache: return _regionMaskCache[key]
+
+    shapes = _parseCRTF(region)
+    if shapes is None: return None
+    if extend != None: shapes.append((True, 'ellipse', [extend, ['900arcsec', '900arcsec'], '90deg']))
+
+    # pixel size (rad) and direction of north and east in pixel coordinates
+    cell = abs(qa.convert(qa.quantity(increment[1], units[1]), 'rad')['value'])
+    sx, sy = np.sign(increment[0]), np.sign(increment[1])
+    world = list(csys.referencevalue()['numeric'])
+    def topix(c):
+        if c[0].endswith('pix'): return float(c[0][:-3]), float(c[1][:-3])
+        world[0] = qa.convert(qa.toangle(c[0]), units[0])['value']
+        world[1] = qa.convert(qa.toangle(c[1]), units[1])['value']
+        return tuple(csys.topixel(world)['numeric'][0:2])
+    def tolen(l):
+        if l.endswith('pix'): return float(l[:-3])
+        return qa.convert(qa.quantity(l), 'rad')['value']/cell
+    def toangle(a):
+        return qa.convert(qa.quantity(a), 'rad')['value']
+
+    mask = np.zeros(shape[0:2], dtype=bool)
+    x = np.arange(shape[0])[:,np.newaxis]
+    y = np.arange(shape[1])[np.newaxis,:]
+    for include, shape_name, p in shapes:
+        if shape_name in ['ellipse', 'circle']:
+            cx, cy = topix(p[0])
+            if shape_name == 'circle': a1 = a2 = tolen(p[1]); pa = 0.
+            else: a1, a2, pa = tolen(p[1][0]), tolen(p[1][1]), toangle(p[2])
+            # CRTF: [b1, b2] are semi-axes, b1 is along pa (from north through east)
+            # and b2 perpendicular to it, whichever is the major
+            u1 = np.sin(pa)*sx*(x-cx) + np.cos(pa)*sy*(y-cy)
+            u2 = np.cos(pa)*sx*(x-cx) - np.sin(pa)*sy*(y-cy)
+            m = (u1/a1)**2 + (u2/a2)**2 <= 1
+        else:
+            if shape_name == 'poly': px, py = zip(*[topix(c) for c in p])
+            elif shape_name == 'box':
+                (x1, y1), (x2, y2) = topix(p[0]), topix(p[1])
+                px, py = [x1, x2, x2, x1], [y1, y1, y2, y2]
+            else:
+                cx, cy = topix(p[0])
+                w, h = tolen(p[1][0])/2., tolen(p[1][1])/2.
+                pa = toangle(p[2]) if shape_name == 'rotbox' else 0.
+                px = [cx + sx*(dx*np.cos(pa) - dy*np.sin(pa)) for dx, dy in [(-w,-h), (w,-h), (w,h), (-w,h)]]
+                py = [cy + sy*(dx*np.sin(pa) + dy*np.cos(pa)) for dx, dy in [(-w,-h), (w,-h), (w,h), (-w,h)]]
+            m = _inPoly(x, y, px, py)
+        if include: mask |= m
+        else: mask &= ~m
+
+    xs, ys = np.where(mask.any(axis=1))[0], np.where(mask.any(axis=0))[0]
+    if len(xs) == 0:
+        logging.warning("Region "+region+" does not include any pixel.")
+        bbox = ([0, 0], [shape[0]-1, shape[1]-1])
+    else: bbox = ([xs[0], ys[0]], [xs[-1], ys[-1]])
+    logging.debug("Region "+region+": "+str(np.sum(mask))+" pixels.")
+    _regionMaskCache[key] = (mask, bbox)
+    return _regionMaskCache[key]
+
+def _extendRegion(region, extend):
+    """Return a copy of the region file with a large ellipse centred in extend=[ra, dec]
+    i.e. "expand" the region
+    """
+    os.system('cp '+region+' '+region.replace('.crtf','-ext.crtf'))
+    region = region.replace('.crtf','-ext.crtf')
+    with open(region, 'a') as f:
+        f.write('ellipse [['+extend[0]+', '+extend[1]+'], [900arcsec, 900arcsec], 90.00000000deg] coord=J2000, corr=[I], linewidth=1, linestyle=-, symsize=1, symthick=1, color=magenta, font=Ubuntu, fontsize=11, fontstyle=normal, usetex=false')
+    return region
+
+def checkRegionMask(img, region, extend=None, tol=0.02):
+    """Compare the mask of _regionMask() with the one of the CASA region tools
+    (rg.fromtextfile) on the image "img", so a different convention (e.g. for the
+    ellipse axes and position angle) is not silently used
+    tol: allowed fraction of differing pixels (pixels on the border may differ)
+    Return True if the masks match
+    """
+    iaLoc = casac.image()
+    iaLoc.open(img)
+    shape = iaLoc.shape()
+    csys = iaLoc.coordsys()
+    regmask = _regionMask(region, csys, shape, extend)
+    if regmask is None:
+        csys.done()
+        iaLoc.close()
+        return False
+    mask = regmask[0]
+    if extend != None: region = _extendRegion(region, extend)
+    reg = rg.fromtextfile(filename=region, shape=shape, csys=csys.torecord())
+    bbox = iaLoc.boundingbox(region=reg)
+    blc, trc = bbox['blc'][0:2], bbox['trc'][0:2]
+    rgmask = np.zeros(shape[0:2], dtype=bool)
+    m = iaLoc.getregion(region=reg, getmask=True)
+    rgmask[blc[0]:trc[0]+1, blc[1]:trc[1]+1] = m.reshape(m.shape[0:2]+(-1,)).any(axis=2)
+    csys.done()
+    iaLoc.close()
+
+    ndiff = np.sum(mask != rgmask)
+    if ndiff > tol*max(1, np.sum(rgmask)):
+        logging.warning("Region "+region+": "+str(ndiff)+" pixels differ from the region tools ("+str(np.sum(rgmask))+" pixels).")
+        return False
+    logging.debug("Region "+region+": mask matches the region tools ("+str(ndiff)+" border pixels differ).")
+    return True
+
+def _extrModelRg(modelimg, region, compl=False, extend=None):
+    """extrModel() with the CASA region tools, for regions not supported by _regionMask()
     """
     blankedmodelimg = []
 
-    # create a new region with a large ellipses i.e. "expand" the region
-    if extend != None:
-        os.system('cp '+region+' '+region.replace('.crtf','-ext.crtf'))
-        region = region.replace('.crtf','-ext.crtf')
-        with open(region, 'a') as f:
-            f.write('ellipse [['+extend[0]+', '+extend[1]+'], [900arcsec, 900arcsec], 90.00000000deg] coord=J2000, corr=[I], linewidth=1, linestyle=-, symsize=1, symthick=1, color=magenta, font=Ubuntu, fontsize=11, fontstyle=normal, usetex=false')
+    if extend != None: region = _extendRegion(region, extend)
 
     for i, modelimgtt in enumerate(modelimg):
         if compl:
@@ -54,21 +214,64 @@ def extrModel(modelimg, region, compl=False, extend=None):
 
     return blankedmodelimg
 
-def invertTable(caltab):
-    """Invert a calibration table
+def extrModel(modelimg, region, compl=False, extend=None, blockmem=64):
+    """Extract only the part described by the region file
+    from one or more (nterms>1) model img
+    compl: instead set to 0 the region, so the rest of the field is untouched
+    extend: [ra, dec], "expand" the region with a large ellipse centred there
+    blockmem: MB of image data processed at once
     """
-    check_rm(caltab+"_inv")
-    syscommand = "cp -r "+caltab+" "+caltab+"_inv"
-    os.system(syscommand)
-    caltab = caltab+"_inv"
-    tb.open(caltab, nomodify=False) # open the caltable
-    gVals = tb.getcol('CPARAM')#, startrow=start, nrow=incr) # get the values from the GAIN column
-    mask = abs(gVals) > 0.0 # only consider non-zero values
-    gVals[mask] = 1.0 / gVals[mask] # do the inversion
-    tb.putcol('CPARAM', gVals)#, startrow=start, nrow=incr) # replace the GAIN values with the inverted values
-    tb.close() # close the table
-    return caltab
-    
+    blankedmodelimg = []
+    name = region.replace('.crtf','')
+    if extend != None: name += '-ext'
+
+    iaout = casac.image()
+    for i, modelimgtt in enumerate(modelimg):
+        ia.open(modelimgtt)
+        shape = ia.shape()
+        csys = ia.coordsys()
+        regmask = _regionMask(region, csys, shape, extend)
+        key = _regionKey(region, csys, shape, extend)
+        if regmask is not None and not key in _regionMaskChecked:
+            ia.close()
+            _regionMaskChecked[key] = checkRegionMask(modelimgtt, region, extend)
+            ia.open(modelimgtt)
+        if regmask is None or not _regionMaskChecked[key]:
+            csys.done()
+            ia.close()
+            logging.warning("Region "+region+" not supported, using the region tools.")
+            return _extrModelRg(modelimg, region, compl, extend)
+        mask, (blc, trc) = regmask
+
+        if compl:
+            outimg = name+"_compl.model.tt"+str(i)
+            blc, trc = [0, 0], [shape[0]-1, shape[1]-1]
+        else:
+            # like immath, the output covers only the region bounding box
+            outimg = name+"_model.tt"+str(i)
+            refpix = csys.referencepixel()['numeric']
+            refpix[0:2] -= blc
+            csys.setreferencepixel(refpix)
+        outshape = [trc[0]-blc[0]+1, trc[1]-blc[1]+1] + list(shape[2:])
+        check_rm(outimg)
+        iaout.fromshape(outfile=outimg, shape=outshape, csys=csys.torecord(), overwrite=True)
+        iaout.setbrightnessunit(ia.brightnessunit())
+
+        nrows = max(1, int(blockmem*1024**2 / (8*np.prod(outshape)/outshape[1])))
+        for y0 in xrange(blc[1], trc[1]+1, nrows):
+            y1 = min(y0+nrows, trc[1]+1)
+            data = ia.getchunk(blc=[blc[0], y0]+[0]*(len(shape)-2), trc=[trc[0], y1-1]+[n-1 for n in shape[2:]])
+            m = mask[blc[0]:trc[0]+1, y0:y1]
+            if compl: m = ~m
+            data = np.where(m.reshape(m.shape + (1,)*(len(shape)-2)), data, 0.)
+            iaout.putchunk(data, blc=[0, y0-blc[1]]+[0]*(len(shape)-2))
+        iaout.close()
+        csys.done()
+        ia.close()
+
+        blankedmodelimg.append(outimg)
+
+    return blankedmodelimg
 
 def findShape(img):
     """Find a minimal shape for the source to peel
@@ -101,22 +304,22 @@ def findCentre(img):
     return epoch, str(directionRA)+'rad', str(directionDEC)+'rad'
 
 
-def subtract(active_ms, modelimg, region='', wprojplanes=0):
+def subtract(active_ms, modelimg, region='', wprojplanes=0, cachedir='', cachesize=20000):
     """General function to call the necessary steps to subtract point sources
     the modelimg must have only point source one wants to sub into the region.
     active_ms: MS with calibrated data in DATA
     modelimg: model of the whole sky (array of tt)
     region: region where is the source to subtract, if empty subtract everything
     wprojplanes: number of w-projection planes, if 0 a direct ft() will be used (best for small field)
+    cachedir, cachesize: cache of the predicted visibilities, see ftModel()
     """
     if region != '': modelimg = extrModel(modelimg, region, compl=False)
-    default('ftw')
-    ftw(vis=active_ms, model=modelimg, nterms=len(modelimg), wprojplanes=wprojplanes, usescratch=True)
+    ftModel(active_ms, modelimg, wprojplanes=wprojplanes, cachedir=cachedir, cachesize=cachesize)
     default('uvsub')
     uvsub(vis=active_ms)
 
 
-def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
+def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True, peeldir='peel/', cachedir='', cachesize=20000, nativecal=False, plan={}):
     """General function to call in sequence all the steps
     s: object with source information
     modelimg: model of the whole sky (single img or array for nterms>1)
@@ -124,21 +327,29 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
     refAnt: is the reference antenna for the calibration step
     rob: robust parameter
     wprojplanes: number of w-projection planes
+    peeldir: working dir, must not be shared by concurrent peel() calls
+    cachedir, cachesize: cache of the predicted visibilities, see ftModel()
+    nativecal: apply the solutions with the numpy engine, see applyCal()
+    plan: arguments of planImaging() for the images of the region
     """
     active_ms = s.ms
     logging.info('Start PEELING of '+region+' on '+active_ms)
     # set subdir
     region_name = region.replace('.crtf','')
-    sd = 'peel/'+region_name+'/'
+    sd = peeldir+region_name+'/'
     check_rm(sd)
     os.makedirs(sd)
     os.makedirs(sd+'cal')
     os.makedirs(sd+'img')
     os.makedirs(sd+'plots')
-    os.system("cp -r "+active_ms+' '+sd+active_ms+'_peel1')
-    os.system("cp -r "+active_ms+' '+sd+active_ms+'_peelr1')
+    # MS names include the region, so that regions can be peeled concurrently
+    peeled_ms = active_ms+'_peel-'+os.path.basename(region_name)
+    ms_base = active_ms+'_'+os.path.basename(region_name)
+    # only the scratch columns are written by subtract()
+    cloneMS(active_ms, sd+ms_base+'_peel1', writecols=['MODEL_DATA','CORRECTED_DATA'])
+    cloneMS(active_ms, sd+ms_base+'_peelr1', writecols=['MODEL_DATA','CORRECTED_DATA'])
     os.system("cp "+region+' '+sd)
-    active_ms = sd+active_ms+'_peel1'
+    active_ms = sd+ms_base+'_peel1'
     region = sd+region
 
     # if modelimg is a single image (nterms=1), put in an array
@@ -147,7 +358,7 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
     # subtract all other sources
     logging.info("PEEL: Subtract all sources in the field...")
     modelimg_reg_compl = extrModel(modelimg, region, compl=True)
-    subtract(active_ms, modelimg_reg_compl, wprojplanes=wprojplanes)
+    subtract(active_ms, modelimg_reg_compl, wprojplanes=wprojplanes, cachedir=cachedir, cachesize=cachesize)
 
     # ft compl model
     logging.info("PEEL: ft of complementary model...")
@@ -165,8 +376,7 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
     #fixvis(active_ms, )
 
     modelimg_reg = extrModel(modelimg, region, compl=False)
-    default('ftw')
-    ftw(vis=active_ms, model=modelimg_reg, nterms=len(modelimg_reg), wprojplanes=wprojplanes, usescratch=True)
+    ftModel(active_ms, modelimg_reg, wprojplanes=wprojplanes, cachedir=cachedir, cachesize=cachesize)
 
     # get some values for clean
     epoch, directionRA, directionDEC = findCentre(modelimg_reg[0])
@@ -180,14 +390,14 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
     default('gaincal')
     gaincal(vis=active_ms, caltable=sd+'cal/peel1.Ga', solint='300s', refant=refAnt, minsnr=1, minblperant=4, calmode='a', uvrange='>50m')
     plotGainCal(sd+'cal/peel1.Ga', amp=True)
-    default('applycal')
-    applycal(vis=active_ms, gaintable=[sd+'cal/peel1.Ga',sd+'cal/peel1.Gp'], calwt=False, flagbackup=False)
+    applyCal(active_ms, [sd+'cal/peel1.Ga',sd+'cal/peel1.Gp'], native=nativecal)
 
+    # small images, see planImaging() for wprojplanes and nterms
+    parms = {'vis':active_ms, 'imagename':sd+'img/peel1', 'mode':'mfs', 'niter':5000, 'gain':0.1, 'psfmode':'clark', \
+        'imagermode':'csclean', 'interactive':False, 'imsize':[shape], 'cell':cell, 'stokes':'I', 'weighting':'briggs', \
+        'robust':rob, 'usescratch':True, 'phasecenter':epoch+' '+directionRA+' '+directionDEC, 'mask':region}
     default('clean')
-    clean(vis=active_ms, imagename=sd+'img/peel1', gridmode='widefield', wprojplanes=wprojplanes, mode='mfs',\
-        niter=5000, gain=0.1, psfmode='clark', imagermode='csclean', interactive=False, imsize=[shape], cell=cell,\
-        stokes='I', nterms=2, weighting='briggs', robust=rob, usescratch=True, phasecenter=epoch+' '+directionRA+' '+directionDEC,\
-        mask=region)
+    clean(**planImaging(parms, **plan))
 
     # selfcal cycle 2
     logging.info("PEEL: Second round of calibration...")
@@ -197,58 +407,52 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
     default('gaincal')
     gaincal(vis=active_ms, caltable=sd+'cal/peel2.Ga', solint='120s', refant=refAnt, minsnr=1, minblperant=4, calmode='a', uvrange='>50m')
     plotGainCal(sd+'cal/peel2.Ga', amp=True)
-    default('applycal')
-    applycal(vis=active_ms, gaintable=[sd+'cal/peel2.Ga',sd+'cal/peel2.Gp'], calwt=False, flagbackup=False)
+    applyCal(active_ms, [sd+'cal/peel2.Ga',sd+'cal/peel2.Gp'], native=nativecal)
 
+    parms['imagename'] = sd+'img/peel2'
     default('clean')
-    clean(vis=active_ms, imagename=sd+'img/peel2', gridmode='widefield', wprojplanes=wprojplanes, mode='mfs',\
-        niter=5000, gain=0.1, psfmode='clark', imagermode='csclean', interactive=False, imsize=[shape], cell=cell,\
-        stokes='I', nterms=2, weighting='briggs', robust=rob, usescratch=True, phasecenter=epoch+' '+directionRA+' '+directionDEC,\
-        mask=region)
+    clean(**parms)
     
     # remove peeled model
-    subtract(active_ms, [sd+'img/peel2.model.tt0',sd+'img/peel2.model.tt1'], wprojplanes=wprojplanes)
+    subtract(active_ms, modelNames(parms['imagename'], parms['nterms']), wprojplanes=parms.get('wprojplanes', 0), \
+        cachedir=cachedir, cachesize=cachesize)
 
     # make image of that part of the sky with DD corrections
     logging.info("PEEL: Make image of peeled region")
     modelimg_regext_compl = extrModel(modelimg, region, compl=True, extend=[directionRA,directionDEC])
     # remove far away sources from initial dataset
     active_ms_reg_sub = active_ms.replace('peel2','peelr1')
-    subtract(active_ms_reg_sub, modelimg_regext_compl, wprojplanes=wprojplanes)
+    subtract(active_ms_reg_sub, modelimg_regext_compl, wprojplanes=wprojplanes, cachedir=cachedir, cachesize=cachesize)
     active_ms_reg = active_ms.replace('peel2','peelr2')
     check_rm(active_ms_reg)
     default('split')
     split(vis=active_ms_reg_sub, outputvis=active_ms_reg)
-    applycal(vis=active_ms_reg, gaintable=[sd+'cal/peel2.Ga',sd+'cal/peel2.Gp'], calwt=False, flagbackup=False)
+    applyCal(active_ms_reg, [sd+'cal/peel2.Ga',sd+'cal/peel2.Gp'], native=nativecal)
     check_rm('img/'+s.name+'/peel_'+region.replace('.crtf','')+'*')
+    parms = {'vis':active_ms_reg, 'imagename':'img/'+s.name+'/peel_'+region.split('/')[-1].replace('.crtf',''), 'mode':'mfs', \
+        'niter':5000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean', 'interactive':False, 'imsize':2000, 'cell':'1arcsec', \
+        'stokes':'I', 'weighting':'briggs', 'robust':rob, 'usescratch':True, 'phasecenter':epoch+' '+directionRA+' '+directionDEC, \
+        'mask':sorted(glob.glob('img/'+s.name+'/self*-masked.mask'))[-1]}
     default('clean')
-    clean(vis=active_ms_reg, imagename='img/'+s.name+'/peel_'+region.split('/')[-1].replace('.crtf',''), gridmode='widefield', wprojplanes=wprojplanes, mode='mfs',\
-        niter=5000, gain=0.1, psfmode='clark', imagermode='csclean', interactive=False, imsize=2000, cell='1arcsec',\
-        stokes='I', nterms=2, weighting='briggs', robust=rob, usescratch=True, phasecenter=epoch+' '+directionRA+' '+directionDEC,\
-        mask=sorted(glob.glob('img/'+s.name+'/self*-masked.mask'))[-1])
-
-    # invert calibration table
-    logging.info("PEEL: Invert solution tables...")
-    invcaltaba = invertTable(sd+'cal/peel2.Ga')
-    plotGainCal(invcaltaba, amp=True)
-    invcaltabp = invertTable(sd+'cal/peel2.Gp')
-    plotGainCal(invcaltabp, phase=True)
+    clean(**planImaging(parms, **plan))
 
     # put sources back
     logging.info("PEEL: Recreating dataset...")
     default('split')
-    split(vis=active_ms, outputvis=active_ms.replace('peel2','peel-'+region_name))
-    active_ms = active_ms.replace('peel2','peel-'+region_name)
+    check_rm(sd+peeled_ms)
+    split(vis=active_ms, outputvis=sd+peeled_ms)
+    active_ms = sd+peeled_ms
     # TODO: phaseshift back
-    default('applycal')
-    applycal(vis=active_ms, gaintable=[invcaltaba,invcaltabp], calwt=False, flagbackup=False)
+    # corrupt back the residuals with the inverse of the solutions
+    applyCal(active_ms, [sd+'cal/peel2.Ga',sd+'cal/peel2.Gp'], inverse=True, native=nativecal)
 
-    default('ftw')
-    ftw(vis=active_ms, model=modelimg_reg_compl, nterms=len(modelimg_reg_compl), wprojplanes=wprojplanes, usescratch=True)
+    # same model and rows as the first subtract(): from the cache if enabled
+    ftModel(active_ms, modelimg_reg_compl, wprojplanes=wprojplanes, cachedir=cachedir, cachesize=cachesize)
     default('uvsub')
     uvsub(vis=active_ms, reverse=True)
 
     # copy the peeled MS in the working dir
+    check_rm(peeled_ms)
     os.system('mv '+active_ms+' .')
     active_ms = active_ms.split('/')[-1]
 
@@ -256,3 +460,49 @@ def peel(s, modelimg, region, refAnt='', rob=0, wprojplanes=512, cleanenv=True):
         check_rm(sd)
 
     return active_ms
+
+
+def combinePeeled(base_ms, peeled_ms, out_ms, memlimit=1024):
+    """Combine regions peeled independently (with peel()) from the same MS
+    each peeled MS has in CORRECTED_DATA the data of base_ms with one region subtracted,
+    out_ms will have all of them subtracted: out = peeled_0 + sum_r>0 (peeled_r - base)
+    flags are the union of the flags of all peeled MSs
+    base_ms: MS used as input of the peel() calls
+    peeled_ms: list of MSs returned by peel()
+    out_ms: output MS
+    memlimit: max memory (MB) used for each data column read at once
+    """
+    cloneMS(peeled_ms[0], out_ms, writecols=['CORRECTED_DATA','FLAG'])
+    if len(peeled_ms) == 1: return out_ms
+
+    tbout = casac.table()
+    tbout.open(out_ms, nomodify=False)
+    tbbase = casac.table()
+    tbbase.open(base_ms)
+    basecol = 'CORRECTED_DATA' if 'CORRECTED_DATA' in tbbase.colnames() else 'DATA'
+    tbpeel = []
+    for ms in peeled_ms[1:]:
+        tbpeel.append(casac.table())
+        tbpeel[-1].open(ms)
+    nrows = tbout.nrows()
+    assert all([t.nrows() == nrows for t in tbpeel+[tbbase]]), "Peeled MSs have different number of rows."
+
+    ncorr, nchan = tbout.getcell('CORRECTED_DATA', 0).shape
+    chunk = max(1, int(memlimit*1024**2/(8*ncorr*nchan)))
+    for row in xrange(0, nrows, chunk):
+        # rows must be the same visibilities in all MSs
+        ref = [tbout.getcol(c, startrow=row, nrow=chunk) for c in ['TIME','ANTENNA1','ANTENNA2']]
+        for t in tbpeel+[tbbase]:
+            assert all([np.array_equal(t.getcol(c, startrow=row, nrow=chunk), r) for c, r in zip(['TIME','ANTENNA1','ANTENNA2'], ref)]), \
+                "Peeled MSs have different rows."
+        data = tbout.getcol('CORRECTED_DATA', startrow=row, nrow=chunk)
+        flag = tbout.getcol('FLAG', startrow=row, nrow=chunk)
+        base = tbbase.getcol(basecol, startrow=row, nrow=chunk)
+        for t in tbpeel:
+            data += t.getcol('CORRECTED_DATA', startrow=row, nrow=chunk) - base
+            flag |= t.getcol('FLAG', startrow=row, nrow=chunk)
+        tbout.putcol('CORRECTED_DATA', data, startrow=row, nrow=chunk)
+        tbout.putcol('FLAG', flag, startrow=row, nrow=chunk)
+
+    for t in tbpeel+[tbbase, tbout]: t.close()
+    return out_ms
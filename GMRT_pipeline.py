@@ -36,15 +36,75 @@
 #taper = '25arcsec'
 # pipeline dir
 #pipdir = '/home/stsf309/GMRTpipeline'
+# optional: max memory (MB) used to read the data when clipping residuals,
+# if set the MS is streamed in time chunks (default: 0, read all at once)
+#clip_memlimit = 2000
+# optional: dir and max size (MB) of the primary beam cache (default: '' no cache)
+#pb_cachedir = '/scratch/pbcache'
+#pb_cachesize = 2000
+# optional: dir and max size (MB) of the cache of predicted model visibilities (default: '' no cache)
+#predict_cachedir = '/scratch/predictcache'
+#predict_cachesize = 20000
+# optional: apply gain tables with the numpy engine of applyCal() instead of applycal, each
+# combination of tables is first checked against applycal on one scan (default: False)
+#native_applycal = True
+# optional: steps to run, the others are skipped (default: the ones below)
+#steps = ['step_env', 'step_import', 'step_preflag', 'step_setjy', 'step_bandpass', 'step_calib', \
+#    'step_selfcal', 'step_peeling', 'step_subtract', 'step_lowresclean']
+# optional: completed steps are recorded in pipeline.checkpoint and skipped when
+# the pipeline is restarted, set this to force a step (and all following) to rerun
+#restart_from = 'step_selfcal'
+# optional: number of sources processed in parallel (selfcal, peeling, imaging), each
+# in its own casa process (casa_cmd) logging to pipeline-<source>.logging (default: 1)
+#ncpu = 4
+#casa_cmd = 'casa'
+# optional: peel all the regions of a source concurrently (up to ncpu, shared among the
+# sources processed in parallel) against the same model and combine them at the end,
+# instead of one after the other (default: False)
+#peel_parallel = True
+# optional: accuracy of the imaging plan (see planImaging()): max w-term phase error (rad)
+# per w-plane (up to maxplanes planes), target dynamic range and spectral index limiting it (nterms=2 if needed)
+#imaging_plan = {'dphi':0.1, 'maxplanes':512, 'dr':1000., 'alpha':0.8}
+# optional: selfcal stops when rms and dynamic range improve less than selfcal_tol (fraction)
+# and the last phase solutions changed less than selfcal_tolgain (deg), but not before
+# cycle selfcal_mincycles nor before the amplitude selfcal (cycle 3) is imaged (default: 0.02, 1, 4)
+# if the phase-only cycles stall in the same way the amplitude selfcal starts straight away
+#selfcal_tol = 0.02
+#selfcal_tolgain = 1.
+#selfcal_mincycles = 4
 
 import os, sys, glob
 import itertools
 import datetime
+import json
 import numpy as np
 execfile('GMRT_pipeline_conf.py')
 execfile(pipdir+'/GMRT_pipeline_lib.py')
 execfile(pipdir+'/GMRT_peeling.py')
-set_logger()
+
+# if set, this is a worker processing a single source (see step_sources())
+if 'GMRTPIP_JOB' in os.environ: job = _jsonStr(json.loads(os.environ['GMRTPIP_JOB']))
+else: job = None
+
+if job is None: set_logger()
+else: set_logger(job['logging'])
+
+# optional parameters
+if not 'clip_memlimit' in globals(): clip_memlimit = 0
+if not 'pb_cachedir' in globals(): pb_cachedir = ''
+if not 'pb_cachesize' in globals(): pb_cachesize = 2000
+if not 'predict_cachedir' in globals(): predict_cachedir = ''
+if not 'predict_cachesize' in globals(): predict_cachesize = 20000
+if not 'native_applycal' in globals(): native_applycal = False
+if not 'steps' in globals(): steps = ['step_selfcal', 'step_peeling', 'step_lowresclean']
+if not 'restart_from' in globals(): restart_from = ''
+if not 'ncpu' in globals(): ncpu = 1
+if not 'casa_cmd' in globals(): casa_cmd = 'casa'
+if not 'peel_parallel' in globals(): peel_parallel = False
+if not 'imaging_plan' in globals(): imaging_plan = {'dphi':0.1, 'maxplanes':512, 'dr':1000., 'alpha':0.8}
+if not 'selfcal_tol' in globals(): selfcal_tol = 0.02
+if not 'selfcal_tolgain' in globals(): selfcal_tolgain = 1.
+if not 'selfcal_mincycles' in globals(): selfcal_mincycles = 4
 
 active_ms = dataf.replace('fits', 'ms').replace('FITS','ms')
 
@@ -181,6 +241,7 @@ def step_preflag(active_ms, freq, n_chan):
     flagdata(vis=active_ms, mode='tfcrop', datacolumn='data',
             timecutoff = 4., freqcutoff = 3., maxnpieces = 7,\
             action='apply', flagbackup=False)
+    flagsChanged(active_ms)
     statsFlag(active_ms, note='End of initial flagging')
 
     # save flag status
@@ -270,10 +331,8 @@ def step_bandpass(active_ms, freq, n_chan, minBL_for_cal):
             gaincal(vis=active_ms, caltable='cal/flux_cal'+str(s.f)+'/'+step+'.K', field=s.f, selectdata=True,\
                 uvrange='>100m', scan=s.fscan, solint='int',combine='', refant=refAnt, interp=interp+['nearest,nearestflag'],\
                 minblperant=minBL_for_cal, minsnr=minsnr,  gaintype='K', gaintable=gaintables+['cal/flux_cal'+str(s.f)+'/'+step+'-boot.B'])
-            # flag outliers
-            FlagCal('cal/flux_cal'+str(s.f)+'/'+step+'.K', sigma = 5, cycles = 3)
-            # plot
-            plotGainCal('cal/flux_cal'+str(s.f)+'/'+step+'.K', delay=True)
+            # flag outliers and plot
+            postCal('cal/flux_cal'+str(s.f)+'/'+step+'.K', sigma = 5, cycles = 3, delay=True)
             gaintables.append('cal/flux_cal'+str(s.f)+'/'+step+'.K')
             interp.append('linear')
 
@@ -283,10 +342,8 @@ def step_bandpass(active_ms, freq, n_chan, minBL_for_cal):
             gaincal(vis=active_ms, caltable='cal/flux_cal'+str(s.f)+'/'+step+'.Gap', field=s.f, selectdata=True,\
                 uvrange='>100m', scan=s.fscan, solint='int',combine='', refant=refAnt, interp=interp+['nearest,nearestflag'],\
                 minblperant=minBL_for_cal, minsnr=minsnr,  gaintype='G', calmode='ap', gaintable=gaintables+['cal/flux_cal'+str(s.f)+'/'+step+'-boot.B'])
-            # flag outliers
-            FlagCal('cal/flux_cal'+str(s.f)+'/'+step+'.Gap', sigma = 3, cycles = 3)
-            # plot
-            plotGainCal('cal/flux_cal'+str(s.f)+'/'+step+'.Gap', amp=True, phase=True)
+            # flag outliers and plot
+            postCal('cal/flux_cal'+str(s.f)+'/'+step+'.Gap', sigma = 3, cycles = 3, amp=True, phase=True)
             gaintables.append('cal/flux_cal'+str(s.f)+'/'+step+'.Gap')
             interp.append('linear')
 
@@ -325,13 +382,12 @@ def step_bandpass(active_ms, freq, n_chan, minBL_for_cal):
             interp.append('nearest,nearestflag')
 
             logging.info("Apply bandpass")
-            default('applycal')
-            applycal(vis=active_ms, selectdata=True, field=s.f, scan=s.fscan,\
-            	gaintable=gaintables, calwt=False, flagbackup=False, interp=interp)
+            applyCal(active_ms, gaintables, interp=interp, field=s.f, scan=s.fscan, native=native_applycal)
+            flagsChanged(active_ms)
             
             if step != 'final':
                 # clip on residuals
-                clipresidual(active_ms, f=s.f, s=s.fscan)
+                clipresidual(active_ms, f=s.f, s=s.fscan, memlimit=clip_memlimit)
 
         # end of 3 bandpass cycles
         done.append(s.f)
@@ -345,13 +401,9 @@ def step_bandpass(active_ms, freq, n_chan, minBL_for_cal):
 
     for s in sources:
         # apply bandpass to gain_cal
-        default('applycal')
-        applycal(vis=active_ms, selectdata=True, field=s.g, scan=s.gscan,\
-            gaintable=gaintables, calwt=False, flagbackup=False, interp=interp)
+        applyCal(active_ms, gaintables, interp=interp, field=s.g, scan=s.gscan, native=native_applycal)
         # apply bandpass to target
-        default('applycal')
-        applycal(vis=active_ms, selectdata=True, field=s.t, scan=s.tscan,\
-            gaintable=gaintables, calwt=False, flagbackup=False, interp=interp)
+        applyCal(active_ms, gaintables, interp=interp, field=s.t, scan=s.tscan, native=native_applycal)
         # fluxcal is already corrected (also with G and K, not a big deal)
 
     statsFlag(active_ms, note='After apply bandpass, before rflag')
@@ -361,6 +413,7 @@ def step_bandpass(active_ms, freq, n_chan, minBL_for_cal):
     flagdata(vis=active_ms, mode='rflag',\
         ntime='scan', combinescans=False, datacolumn='corrected', winsize=3,\
         timedevscale=5, freqdevscale=5, action='apply', flagbackup=False)
+    flagsChanged(active_ms)
 
     # flag statistics after flagging
     statsFlag(active_ms, note='After rflag')
@@ -406,8 +459,7 @@ def step_calib(active_ms, freq, minBL_for_cal):
                 uvrange='>100m', scan=",".join(filter(None, [s.fscan,s.gscan])), solint='int', \
                 refant=refAnt, minblperant=minBL_for_cal, minsnr=minsnr,  gaintype='K', interp=interp+['linear'],\
                 gaintable=gaintables+['cal/'+s.name+'/gain'+str(cycle)+'-boot.Gp'])
-            FlagCal('cal/'+s.name+'/gain'+str(cycle)+'.K', sigma = 5, cycles = 3)
-            plotGainCal('cal/'+s.name+'/gain'+str(cycle)+'.K', delay=True)
+            postCal('cal/'+s.name+'/gain'+str(cycle)+'.K', sigma = 5, cycles = 3, delay=True)
 
             default('gaincal')
             gaincal(vis=active_ms, caltable='cal/'+s.name+'/gain'+str(cycle)+'.Gp', field=s.g+','+s.f, selectdata=True,\
@@ -432,7 +484,7 @@ def step_calib(active_ms, freq, minBL_for_cal):
             gaincal(vis=active_ms, caltable='cal/'+s.name+'/gain'+str(cycle)+'.Ga', field=s.g+','+s.f,\
             	selectdata=True, uvrange='>100m', scan=",".join(filter(None, [s.fscan,s.gscan])), \
                 solint='60s', minsnr=minsnr, refant=refAnt, minblperant=minBL_for_cal, calmode='a', gaintable=gaintables)
-            FlagCal('cal/'+s.name+'/gain'+str(cycle)+'.Ga', sigma = 3, cycles = 3)
+            gacal = FlagCal('cal/'+s.name+'/gain'+str(cycle)+'.Ga', sigma = 3, cycles = 3)
     
             # if gain and flux cal are the same the fluxscale cannot work
             # do it only in the last cycle, so the next clip can work, otherwise the uvsub subtract
@@ -448,7 +500,7 @@ def step_calib(active_ms, freq, minBL_for_cal):
                 gaintables.append('cal/'+s.name+'/gain'+str(cycle)+'.Ga_fluxscale')
                 interp.append('linear')
             else:
-                plotGainCal('cal/'+s.name+'/gain'+str(cycle)+'.Ga', amp=True)
+                plotGainCal('cal/'+s.name+'/gain'+str(cycle)+'.Ga', amp=True, cal=gacal)
                 gaintables.append('cal/'+s.name+'/gain'+str(cycle)+'.Ga')
                 interp.append('linear')
      
@@ -462,44 +514,35 @@ def step_calib(active_ms, freq, minBL_for_cal):
             #gaintables.append('cal/'+s.name+'/gain'+str(cycle)+'.BLap')
             #interp.append('nearest')
 
-            default('applycal')
-            applycal(vis=active_ms, field=s.g, scan=s.gscan, gaintable=gaintables, interp=interp,\
-                calwt=False, flagbackup=False)
+            applyCal(active_ms, gaintables, interp=interp, field=s.g, scan=s.gscan, native=native_applycal)
+            flagsChanged(active_ms)
             
             # clip of residuals not on the last cycle (useless and prevent imaging of calibrator)
             if cycle != n_cycles-1:
-                clipresidual(active_ms, f=s.g, s=s.gscan)
+                clipresidual(active_ms, f=s.g, s=s.gscan, memlimit=clip_memlimit)
 
             # store list of gaintables to apply later
             s.gaintables = gaintables
             s.interp = interp
 
         # make a test img of the gain cal to check that everything is fine
-        parms = {'vis':active_ms, 'field':s.g, 'imagename':'img/'+s.name+'_gcal', 'gridmode':'widefield', 'wprojplanes':128,\
-              	'mode':'mfs', 'nterms':2, 'niter':1000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+        parms = {'vis':active_ms, 'field':s.g, 'imagename':'img/'+s.name+'_gcal',\
+              	'mode':'mfs', 'niter':1000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
            	    'imsize':512, 'cell':sou_res, 'weighting':'briggs', 'robust':0, 'usescratch':False}
-        cleanmaskclean(parms, s, makemask=False)
+        cleanmaskclean(parms, s, makemask=False, plan=imaging_plan)
     
     # use a different cycle to compensate for messing up with uvsub during the calibration of other sources
     # in this way the CRRECTED_DATA are OK for all fields
     for s in sources:
 
         # apply B, Gp, Ga
-        default('applycal')
-        applycal(vis=active_ms, field=s.f,\
-        	scan=s.fscan, gaintable=s.gaintables, \
-            gainfield=[s.f, s.f, s.f],\
-        	interp=s.interp, calwt=False, flagbackup=False)
-        default('applycal')
-        applycal(vis=active_ms, field=s.g,\
-        	scan=",".join(filter(None, [s.fscan,s.gscan])), gaintable=s.gaintables, \
-            gainfield=[s.f, s.g, s.g],\
-        	interp=s.interp, calwt=False, flagbackup=False)
-        default('applycal')
-        applycal(vis=active_ms, field=s.t,\
-        	scan=",".join(filter(None, [s.fscan,s.gscan,s.tscan])), gaintable=s.gaintables, \
-            gainfield=[s.f, s.g, s.g], \
-        	interp=s.interp, calwt=False, flagbackup=False)
+        applyCal(active_ms, s.gaintables, interp=s.interp, field=s.f, scan=s.fscan, \
+            gainfield=[s.f, s.f, s.f], native=native_applycal)
+        applyCal(active_ms, s.gaintables, interp=s.interp, field=s.g, scan=",".join(filter(None, [s.fscan,s.gscan])), \
+            gainfield=[s.f, s.g, s.g], native=native_applycal)
+        applyCal(active_ms, s.gaintables, interp=s.interp, field=s.t, scan=",".join(filter(None, [s.fscan,s.gscan,s.tscan])), \
+            gainfield=[s.f, s.g, s.g], native=native_applycal)
+    flagsChanged(active_ms)
 
     
 #######################################
@@ -518,35 +561,56 @@ def step_selfcal(active_ms, freq, minBL_for_cal):
    
     for s in sources:
 
-        check_rm('plots/'+s.name+'/self')
-        os.makedirs('plots/'+s.name+'/self')
-        check_rm('img/'+s.name)
-        os.makedirs('img/'+s.name)
-        check_rm('cal/'+s.name+'/self')
-        os.makedirs('cal/'+s.name+'/self')
-        check_rm('target_'+s.name+'.ms')
-    
-        default('split')
-        split(vis=active_ms, outputvis=s.ms,\
-        	field=s.t, width=width, datacolumn='corrected', keepflags=False)
-    
-        for cycle in xrange(6):
+        # resume from the last completed cycle of an interrupted run
+        resume = runner.getPartial(s.name)
+        if resume is not None and resume['done']:
+            logging.info("Selfcal of "+s.name+" already done.")
+            continue
+        elif resume is not None:
+            logging.info("Resume selfcal of "+s.name+" after cycle "+str(resume['cycle']))
+            old_rms = resume['rms']
+            gaintable = resume['gaintable']
+            startcycle = resume['cycle']+1
+            skip = resume.get('skip', 0)
+            monitor = SelfcalMonitor(s.name, selfcal_tol, selfcal_tolgain, selfcal_mincycles, ampcycle=3, history=resume['history'])
+        else:
+            check_rm('plots/'+s.name+'/self')
+            os.makedirs('plots/'+s.name+'/self')
+            check_rm('img/'+s.name)
+            os.makedirs('img/'+s.name)
+            check_rm('cal/'+s.name+'/self')
+            os.makedirs('cal/'+s.name+'/self')
+            check_rm('target_'+s.name+'.ms')
+        
+            default('split')
+            split(vis=active_ms, outputvis=s.ms,\
+            	field=s.t, width=width, datacolumn='corrected', keepflags=False)
+            startcycle = 0
+            skip = 0
+            monitor = SelfcalMonitor(s.name, selfcal_tol, selfcal_tolgain, selfcal_mincycles, ampcycle=3)
+    
+        # cycle numbers the images/tables, stage (cycle + skipped stages) is the
+        # position in the schedule (solints, amplitude from stage 3, stop after stage 5)
+        for cycle in itertools.count(startcycle):
+            stage = cycle + skip
      
-            logging.info("Start SELFCAL cycle: "+str(cycle))
+            logging.info("Start SELFCAL cycle: "+str(cycle)+" (stage "+str(stage)+")")
+            monitor.start(cycle, stage)
             
             # save flag for recovering
             default('flagmanager')
             flagmanager(vis=s.ms, mode='save', versionname='selfcal-c'+str(cycle))
 
-            ts = str(s.expnoise*10*(5-cycle))+' Jy' # expected noise this cycle
-            parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/self'+str(cycle), 'gridmode':'widefield', 'wprojplanes':512,\
-          	    'mode':'mfs', 'nterms':2, 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+            ts = str(s.expnoise*10*(5-stage))+' Jy' # expected noise this cycle
+            parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/self'+str(cycle),\
+          	    'mode':'mfs', 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
            	    'imsize':sou_size, 'cell':sou_res, 'weighting':'briggs', 'robust':rob, 'usescratch':True, 'mask':s.mask,\
                 'threshold':ts, 'multiscale':s.multiscale}
-            cleanmaskclean(parms, s)
+            cleanmaskclean(parms, s, plan=imaging_plan)
 
             # Get img rms and if it higher apply old gaintables/flags and quit
-            rms = imstat(imagename='img/'+s.name+'/self'+str(cycle)+'-masked.image.tt0',mask='img/'+s.name+'/self'+str(cycle)+'\-masked.mask < 1')['rms'][0] # "<1" is to invert the mask
+            rms = imstat(imagename=imgName(parms['imagename'], parms['nterms']),mask='img/'+s.name+'/self'+str(cycle)+'\-masked.mask < 1')['rms'][0] # "<1" is to invert the mask
+            monitor.image(imgName(parms['imagename'], parms['nterms']), rms)
             if cycle != 0 and old_rms * 1.1 < rms:
                 logging.warning('Image rms noise ('+str(rms)+' Jy/b) is higher than previous cycle ('+str(old_rms)+' Jy/b). Apply old cal tables and quitting selfcal.')
 
@@ -556,54 +620,58 @@ def step_selfcal(active_ms, freq, minBL_for_cal):
                 # get previous flags
                 default('flagmanager')
                 flagmanager(vis=s.ms, mode='restore', versionname='selfcal-c'+str(cycle-1))
+                flagsChanged(s.ms)
                 
                 # for the first cycle just remove all calibration i.e. no selfcal
                 # for the others get the previous (i.e. cycle-2) cycle tables
                 if cycle == 1:
                     default('clearcal')
                     clearcal(vis=s.ms)
-                elif cycle < 4:
-                    plotGainCal('cal/'+s.name+'/self/gain'+str(cycle-2)+'.Gp', phase=True)
-                    default('applycal')
-                    applycal(vis=s.ms, gaintable=gaintable, interp=['linear','linear'], calwt=False, flagbackup=False)           
-                elif cycle >= 4: 
+                else:
                     plotGainCal('cal/'+s.name+'/self/gain'+str(cycle-2)+'.Gp', phase=True)
-                    plotGainCal('cal/'+s.name+'/self/gain'+str(cycle-2)+'.Ga', amp=True)
-                    default('applycal')
-                    applycal(vis=s.ms, gaintable=gaintable, interp=['linear','linear'], calwt=False, flagbackup=False)           
+                    if os.path.exists('cal/'+s.name+'/self/gain'+str(cycle-2)+'.Ga'):
+                        plotGainCal('cal/'+s.name+'/self/gain'+str(cycle-2)+'.Ga', amp=True)
+                    applyCal(s.ms, gaintable, interp=['linear','linear'], native=native_applycal)
 
                 break
 
             elif cycle != 0:
                 logging.info('Rms noise change: '+str(old_rms)+' Jy/b -> '+str(rms)+' Jy/b.')
 
-            if cycle == 5: break # don't do one more useless calibration
+            if stage == 5: break # don't do one more useless calibration
+
+            # stop if the last calibration did not improve the image
+            if monitor.converged(): break
+
+            # phase-only cycles stalled: calibrate straight away as in the amplitude stage
+            if monitor.skipPhase():
+                skip += monitor.ampcycle - stage
+                stage = monitor.ampcycle
 
             old_rms = rms
  
             # ft() model back - if clean doesn't converge clean() fail to put the model, better do it by hand
-            default('ftw')
-            ftw(vis=s.ms, model=['img/'+s.name+'/self'+str(cycle)+'-masked.model.tt0','img/'+s.name+'/self'+str(cycle)+'-masked.model.tt1'], \
-                    nterms=2, wprojplanes=512, usescratch=True)
+            ftModel(s.ms, modelNames(parms['imagename'], parms['nterms']), wprojplanes=parms.get('wprojplanes', 0), \
+                    cachedir=predict_cachedir, cachesize=predict_cachesize)
             
             # recalibrating    
             refAntObj = RefAntHeuristics(vis=s.ms, field='0', geometry=True, flagging=True)
             refAnt = refAntObj.calculate()[0]
 
             # Gaincal - phases
-            if cycle==0: 
+            if stage==0: 
                 solint='600s'
                 minsnr=4
-            if cycle==1: 
+            if stage==1: 
                 solint='120s'
                 minsnr=3
-            if cycle==2: 
+            if stage==2: 
                 solint='30s'
                 minsnr=3
-            if cycle==3:
+            if stage==3:
                 solint='int'
                 minsnr=2
-            if cycle==4:
+            if stage==4:
                 solint='int'
                 minsnr=2
 
@@ -613,10 +681,12 @@ def step_selfcal(active_ms, freq, minBL_for_cal):
             default('gaincal')
             gaincal(vis=s.ms, caltable='cal/'+s.name+'/self/gain'+str(cycle)+'.Gp', solint=solint, minsnr=minsnr,\
             	selectdata=True, uvrange='>50m', refant=refAnt, minblperant=minBL_for_cal, gaintable=[], calmode='p')
+            if cycle > 0:
+                monitor.gains('cal/'+s.name+'/self/gain'+str(cycle)+'.Gp', 'cal/'+s.name+'/self/gain'+str(cycle-1)+'.Gp')
 
             # Delay correction: find leftover time-dependent delays
             # TODO: Is it a good way since delays are DDE?
-#            if cycle >= 3:
+#            if stage >= 3:
 #                default('gaincal')
 #                gaincal(vis=s.ms, caltable='cal/'+s.name+'/self/gain'+str(cycle)+'.K', solint=solint, minsnr=minsnr,\
 #                    selectdata=True, uvrange='>50m', refant=refAnt, minblperant=minBL_for_cal, gaintype='K', \
@@ -629,11 +699,11 @@ def step_selfcal(active_ms, freq, minBL_for_cal):
 #                applycal(vis=s.ms, field = '', gaintable=['cal/'+s.name+'/self/gain'+str(cycle)+'.K'], calwt=False, flagbackup=False, applymode='flagonly') 
             
             # Gaincal - amp
-            if cycle >= 3:        
-                    if cycle==3: 
+            if stage >= 3:        
+                    if stage==3: 
                         solint='600s'
                         minsnr = 4.
-                    if cycle==4: 
+                    if stage==4: 
                         solint='300s'
                         minsnr = 3.
                     if freq < 400e6:
@@ -642,28 +712,32 @@ def step_selfcal(active_ms, freq, minBL_for_cal):
                     gaincal(vis=s.ms, caltable='cal/'+s.name+'/self/gain'+str(cycle)+'.Ga',\
                     	selectdata=True, uvrange='>50m', solint=solint, minsnr=minsnr, refant=refAnt,\
                     	minblperant=minBL_for_cal, gaintable=[], calmode='a')
-                    FlagCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Ga', sigma = 3, cycles = 3)
+                    gacal = FlagCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Ga', sigma = 3, cycles = 3)
      
             # plot gains
-            if cycle >= 3: 
+            if stage >= 3: 
                 plotGainCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Gp', phase=True)
-                plotGainCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Ga', amp=True)
+                plotGainCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Ga', amp=True, cal=gacal)
             else:
                 plotGainCal('cal/'+s.name+'/self/gain'+str(cycle)+'.Gp', phase=True)
             
             # add to gaintable
-            if cycle >= 3: 
+            if stage >= 3: 
                 gaintable=['cal/'+s.name+'/self/gain'+str(cycle)+'.Gp',\
                 	'cal/'+s.name+'/self/gain'+str(cycle)+'.Ga']
                     #'cal/'+s.name+'/self/gain'+str(cycle)+'.K'
             else:
                 gaintable=['cal/'+s.name+'/self/gain'+str(cycle)+'.Gp']
 
-            default('applycal')
-            applycal(vis=s.ms, field = '', gaintable=gaintable, interp=['linear','linear'], calwt=False, flagbackup=False)           
+            applyCal(s.ms, gaintable, interp=['linear','linear'], native=native_applycal)
+            flagsChanged(s.ms)
             statsFlag(s.ms, note='After apply selfcal (cycle: '+str(cycle)+')') 
+            runner.setPartial(s.name, {'cycle':cycle, 'skip':skip, 'rms':float(rms), 'gaintable':gaintable, 'done':False, \
+                'history':monitor.history})
 
         # end of selfcal loop
+        monitor.summary(6)
+        runner.setPartial(s.name, {'done':True})
     
     # end of cycle on sources
   
@@ -676,23 +750,47 @@ def step_peeling():
 
     for s in sources:
         check_rm('img/'+s.name+'/peel*')
-        check_rm('peel')
-        os.makedirs('peel')
-        modelforpeel = [sorted(glob.glob('img/'+s.name+'/self*-masked.model.tt0'))[-1], sorted(glob.glob('img/'+s.name+'/self*-masked.model.tt1'))[-1]]
+        # per source dir, sources can be peeled concurrently
+        check_rm('peel/'+s.name)
+        os.makedirs('peel/'+s.name)
+        lastself = sorted(glob.glob('img/'+s.name+'/self*-masked.model*'))[-1].split('.model')[0]
+        modelforpeel = sorted(glob.glob(lastself+'.model*'))
+        wprojplanes = wprojPlanes(s.ms, sou_size, sou_res, imaging_plan.get('dphi', 0.1), imaging_plan.get('maxplanes', 512))
         refAntObj = RefAntHeuristics(vis=s.ms, field='0', geometry=True, flagging=True)
         refAnt = refAntObj.calculate()[0]
 
+        if peel_parallel and ncpu > 1 and len(s.peel) > 1:
+            # each region in a worker (see job['region']) against the same model, then combine
+            jobs = [{'source':s.name, 'region':sourcetopeel, 'ms':s.ms, 'model':modelforpeel, 'refant':refAnt, 'wprojplanes':wprojplanes, \
+                'peeldir':'peel/'+s.name+'/r'+str(i)+'/', 'log':'peel/'+s.name+'/r'+str(i)+'.out', \
+                'logging':'peel/'+s.name+'/r'+str(i)+'.logging', 'result':'peel/'+s.name+'/r'+str(i)+'.result'} \
+                for i, sourcetopeel in enumerate(s.peel)]
+            results = runWorkers(jobs, ncpu, [casa_cmd, '--nologger', '--nogui', '--log2term', '-c', pipdir+'/GMRT_pipeline.py'])
+            if None in results:
+                logging.error("Peeling of "+s.name+" failed.")
+                sys.exit(1)
+            s.ms = combinePeeled(s.ms, [result['ms'] for result in results], s.ms+'_peeled')
+
+            i = len(s.peel)-1
+            parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/peel'+str(i),\
+            	'mode':'mfs', 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+        	    'imsize':sou_size, 'cell':sou_res, 'weighting':'briggs', 'robust':rob, 'usescratch':True, 'mask':s.mask,\
+                'threshold':str(s.expnoise)+' Jy', 'multiscale':s.multiscale}
+            cleanmaskclean(parms, s, plan=imaging_plan)
+            continue
+
         for i, sourcetopeel in enumerate(s.peel):
 
-            s.ms = peel(s, modelforpeel, sourcetopeel, refAnt, rob, cleanenv=False)
+            s.ms = peel(s, modelforpeel, sourcetopeel, refAnt, rob, wprojplanes=wprojplanes, cleanenv=False, peeldir='peel/'+s.name+'/', \
+                cachedir=predict_cachedir, cachesize=predict_cachesize, nativecal=native_applycal, plan=imaging_plan)
  
-            parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/peel'+str(i), 'gridmode':'widefield', 'wprojplanes':512,\
-            	'mode':'mfs', 'nterms':2, 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+            parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/peel'+str(i),\
+            	'mode':'mfs', 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
         	    'imsize':sou_size, 'cell':sou_res, 'weighting':'briggs', 'robust':rob, 'usescratch':True, 'mask':s.mask,\
                 'threshold':str(s.expnoise)+' Jy', 'multiscale':s.multiscale}
-            cleanmaskclean(parms, s)
+            cleanmaskclean(parms, s, plan=imaging_plan)
        
-            modelforpeel = ['img/'+s.name+'/peel'+str(i)+'-masked.model.tt0','img/'+s.name+'/peel'+str(i)+'-masked.model.tt1']
+            modelforpeel = modelNames(parms['imagename'], parms['nterms'])
 
 #######################################
 # Subtract point sources
@@ -704,18 +802,19 @@ def step_subtract():
         check_rm(s.ms+'-sub')
         check_rm('img/'+s.name+'/hires*')
 
-        os.system('cp -r '+s.ms+' '+s.ms+'-sub')
-        s.ms = s.ms+'-sub'
+        # clean and subtract() write only the scratch columns
+        s.ms = cloneMS(s.ms, s.ms+'-sub', writecols=['MODEL_DATA','CORRECTED_DATA'])
 
         # make a high res image to remove all the extended components
-        parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/hires', 'gridmode':'widefield', 'wprojplanes':512,\
-           	'mode':'mfs', 'nterms':2, 'niter':5000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+        parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/hires',\
+           	'mode':'mfs', 'niter':5000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
             'imsize':sou_size, 'cell':sou_res, 'weighting':'briggs', 'robust':rob-1, 'usescratch':True, 'mask':s.mask, \
             'selectdata':True, 'uvrange':'>4klambda','threshold':str(s.expnoise)+' Jy', 'multiscale':[]}
-        cleanmaskclean(parms, s)
+        cleanmaskclean(parms, s, plan=imaging_plan)
 
         # subtract 
-        subtract(s.ms, ['img/'+s.name+'/hires-masked.model.tt0','img/'+s.name+'/hires-masked.model.tt1'], region=s.sub, wprojplanes=512)
+        subtract(s.ms, modelNames(parms['imagename'], parms['nterms']), region=s.sub, wprojplanes=parms.get('wprojplanes', 0), \
+            cachedir=predict_cachedir, cachesize=predict_cachesize)
 
 
 #######################################
@@ -726,25 +825,79 @@ def step_lowresclean():
     for s in sources:
         check_rm('img/'+s.name+'/lowres*')
 
-        parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/lowres', 'gridmode':'widefield', 'wprojplanes':512,\
-           	'mode':'mfs', 'nterms':2, 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
+        parms = {'vis':s.ms, 'imagename':'img/'+s.name+'/lowres',\
+           	'mode':'mfs', 'niter':10000, 'gain':0.1, 'psfmode':'clark', 'imagermode':'csclean',\
             'imsize':sou_size, 'cell':sou_res, 'weighting':'briggs', 'robust':rob, 'usescratch':True, 'mask':s.mask, \
             'uvtaper':True, 'outertaper':[taper], 'threshold':str(s.expnoise)+' Jy', 'multiscale':s.multiscale}
-        cleanmaskclean(parms, s)
+        cleanmaskclean(parms, s, plan=imaging_plan)
         
         # pbcorr
-        correctPB('img/'+s.name+'/lowres-masked.image.tt0', freq, phaseCentre=None)
+        correctPB(imgName(parms['imagename'], parms['nterms']), freq, phaseCentre=None, \
+            cachedir=pb_cachedir, cachesize=pb_cachesize)
  
 
-# steps to execute
-#step_env()
-#step_import()
+#######################################
+# Per-source steps in parallel
+
+def step_sources():
+    logging.info("### PER-SOURCE STEPS ("+str(ncpu)+" parallel workers)")
+
+    # workers redo their steps if anything upstream changed, each one gets its share
+    # of the cpus (for parallel peeling) so that at most ncpu processes run at once
+    jobs = [{'source':s.name, 'log':'pipeline-'+s.name+'.out', 'result':'pipeline-'+s.name+'.result', \
+        'logging':'pipeline-'+s.name+'.logging', 'upstream':runner.upstream(), \
+        'ncpu':max(1, ncpu // min(ncpu, len(sources)))} for s in sources]
+    results = runWorkers(jobs, ncpu, [casa_cmd, '--nologger', '--nogui', '--log2term', '-c', pipdir+'/GMRT_pipeline.py'])
+
+    # merge results back
+    for s, result in zip(sources, results):
+        if result is None:
+            logging.error("Processing of "+s.name+" failed.")
+            sys.exit(1)
+        s.ms = result['ms']
+        s.images = result['images']
+
+
+# steps to execute, only the enabled ones run (see steps) and completed steps are skipped (see restart_from)
 freq, minBL_for_cal, sources, n_chan = step_setvars(active_ms) # NOTE: do not commment this out!
-#step_preflag(active_ms, freq, n_chan)
-#step_setjy(active_ms)
-#step_bandpass(active_ms, freq, n_chan, minBL_for_cal)
-#step_calib(active_ms, freq, minBL_for_cal)
-step_selfcal(active_ms, freq, minBL_for_cal)
-step_peeling()
-#step_subtract()
-step_lowresclean()
+
+# steps done independently for each source (see step_sources())
+def source_steps(runner):
+    runner.run(step_selfcal, active_ms, freq, minBL_for_cal)
+    runner.run(step_peeling)
+    runner.run(step_subtract)
+    runner.run(step_lowresclean)
+
+if job is not None and 'region' in job:
+    # worker: peel a single region (see step_peeling())
+    s = [s for s in sources if s.name == job['source']][0]
+    s.ms = job['ms']
+    peeled_ms = peel(s, job['model'], job['region'], job['refant'], rob, wprojplanes=job['wprojplanes'], cleanenv=False, peeldir=job['peeldir'], \
+        cachedir=predict_cachedir, cachesize=predict_cachesize, nativecal=native_applycal, plan=imaging_plan)
+    with open(job['result'], 'w') as f:
+        json.dump({'ms':peeled_ms}, f)
+elif job is not None:
+    # worker: process only one source with its own checkpoint
+    sources = [s for s in sources if s.name == job['source']]
+    ncpu = job['ncpu']
+    runner = StepRunner('pipeline-'+job['source']+'.checkpoint', sources, inputs=['GMRT_pipeline_conf.py'], \
+        restart_from=restart_from, upstream=job['upstream'], enabled=steps)
+    source_steps(runner)
+    with open(job['result'], 'w') as f:
+        json.dump({'ms':sources[0].ms, 'images':sorted(glob.glob('img/'+job['source']+'/*'))}, f)
+else:
+    # per-source steps are all inside step_sources() when in parallel
+    sourcesteps = ['step_selfcal', 'step_peeling', 'step_subtract', 'step_lowresclean']
+    enabled = steps + (['step_sources'] if set(steps) & set(sourcesteps) else [])
+    if ncpu > 1 and len(sources) > 1 and restart_from in sourcesteps:
+        runner = StepRunner('pipeline.checkpoint', sources, inputs=['GMRT_pipeline_conf.py'], restart_from='step_sources', enabled=enabled)
+    else:
+        runner = StepRunner('pipeline.checkpoint', sources, inputs=['GMRT_pipeline_conf.py'], restart_from=restart_from, enabled=enabled)
+    runner.run(step_env)
+    runner.run(step_import)
+    runner.run(step_preflag, active_ms, freq, n_chan)
+    runner.run(step_setjy, active_ms)
+    runner.run(step_bandpass, active_ms, freq, n_chan, minBL_for_cal)
+    runner.run(step_calib, active_ms, freq, minBL_for_cal)
+    if ncpu > 1 and len(sources) > 1: runner.run(step_sources)
+    else: source_steps(runner)
@@ -5,17 +5,172 @@
 import logging
 import numpy as np
 
+class _Trash(object):
+    """Background deleter: paths are renamed to a hidden name in the same dir
+    (so they are free immediately) and removed by a pool of threads
+    all pending deletions are completed at exit, leftovers of dead processes
+    (e.g. failed deletions) are removed on the next call in the same dir
+    """
+    def __init__(self, nthreads=4):
+        import Queue, threading, atexit
+        self.queue = Queue.Queue()
+        self.count = 0
+        self.swept = set()
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+        atexit.register(self.drain)
+
+    @staticmethod
+    def _remove(path):
+        """Remove a file or dir, each failed removal (e.g. NFS silly-rename, locks
+        still held) is retried once after a while
+        """
+        import shutil, time
+        def retry(func, p, excinfo):
+            time.sleep(2)
+            if os.path.lexists(p): func(p)
+        if not os.path.lexists(path): return
+        if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path, ignore_errors=False, onerror=retry)
+        else: os.remove(path)
+
+    def _worker(self):
+        while True:
+            path = self.queue.get()
+            try:
+                self._remove(path)
+            except Exception as e:
+                logging.warning("Cannot remove "+path+" (retried on the next run): "+str(e))
+            self.queue.task_done()
+
+    def sweep(self, dirname):
+        """Queue the trash left in dirname by processes no longer running
+        """
+        import glob, errno
+        dirname = os.path.abspath(dirname)
+        if dirname in self.swept: return
+        self.swept.add(dirname)
+        for trash in glob.glob(os.path.join(dirname, '.trash-*')):
+            try:
+                os.kill(int(os.path.basename(trash).split('-')[1]), 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH: self.queue.put(trash)
+            except ValueError:
+                self.queue.put(trash)
+
+    def put(self, path):
+        path = path.rstrip('/')
+        if not os.path.lexists(path): return
+        self.count += 1
+        trash = os.path.join(os.path.dirname(path), '.trash-'+str(os.getpid())+'-'+str(self.count)+'-'+os.path.basename(path))
+        try:
+            os.rename(path, trash)
+        except OSError:
+            # cannot rename, remove it now (unless it has just disappeared)
+            if not os.path.lexists(path): return
+            self._remove(path)
+            return
+        self.queue.put(trash)
+
+    def drain(self):
+        """Wait for all pending deletions
+        """
+        self.queue.join()
+
+_trash = None
+
 def check_rm(regexp):
     """
-    Check if file exists and remove it
+    Check if file exists and remove it (in background, the path is free on return)
     Handle reg exp of glob and spaces
+    regexp: space separated globs, or a list of globs (which can contain spaces)
     """
     import os, glob
-    filenames = regexp.split(' ')
+    global _trash
+    if _trash is None: _trash = _Trash()
+    if isinstance(regexp, list): filenames = regexp
+    else: filenames = regexp.split(' ')
     for filename in filenames:
+        _trash.sweep(os.path.dirname(filename.rstrip('/')) or '.')
         # glob is used to check if file exists
         for f in glob.glob(filename):
-            os.system('rm -r '+f)
+            _trash.put(f)
+
+def _reflink(src, dst):
+    """Copy-on-write copy of a file (FICLONE ioctl), return False if not supported
+    """
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                failed = True
+            else:
+                failed = False
+    if failed: os.remove(dst)
+    return not failed
+
+# columns never written in place by the pipeline, their storage can be shared by cloneMS()
+_immutableCols = ['DATA', 'UVW', 'TIME', 'TIME_CENTROID', 'INTERVAL', 'EXPOSURE', 'ANTENNA1', 'ANTENNA2', \
+    'ANTENNA3', 'FEED1', 'FEED2', 'FEED3', 'DATA_DESC_ID', 'FIELD_ID', 'SCAN_NUMBER', 'ARRAY_ID', \
+    'OBSERVATION_ID', 'PROCESSOR_ID', 'STATE_ID', 'PHASE_ID', 'PULSAR_BIN', 'PULSAR_GATE_ID']
+
+def cloneMS(src, dst, writecols=None, nthreads=8):
+    """Duplicate a table (MS or caltable) as cheaply as the filesystem allows:
+    reflinks if supported, otherwise hardlinks for the storage files of the immutable
+    columns (see _immutableCols) which will not be written and real copies (in parallel)
+    for everything else (FLAG is always copied)
+    src: table to clone
+    dst: new table (removed if existing)
+    writecols: columns that may be written in dst, if None (default) everything is copied.
+    NOTE: hardlinked columns are shared, they must not be modified in src or dst (no
+    new rows, no writing to columns not listed in writecols)
+    nthreads: parallel copies
+    """
+    import shutil, errno
+    from multiprocessing.pool import ThreadPool
+    check_rm(dst)
+    logging.debug("Cloning "+src+" -> "+dst)
+
+    files = []
+    for root, dirs, fnames in os.walk(src):
+        os.makedirs(os.path.join(dst, os.path.relpath(root, src)))
+        files += [os.path.relpath(os.path.join(root, f), src) for f in fnames]
+
+    # try reflinks
+    reflink = bool(files) and _reflink(os.path.join(src, files[0]), os.path.join(dst, files[0]))
+
+    # storage files of the main table which can be shared
+    links = set()
+    if writecols is not None and not reflink:
+        tbLoc = casac.table()
+        tbLoc.open(src)
+        allcols = tbLoc.colnames()
+        tbLoc.close()
+        readonly = [c for c in allcols if c in _immutableCols and not c in writecols]
+        writable = [os.path.relpath(f, src) for f in _dmFiles(src, [c for c in allcols if not c in readonly])]
+        links = set([os.path.relpath(f, src) for f in _dmFiles(src, readonly)]) - set(writable)
+
+    def copy(f):
+        fsrc, fdst = os.path.join(src, f), os.path.join(dst, f)
+        if reflink and _reflink(fsrc, fdst): return
+        if f in links:
+            try:
+                os.link(fsrc, fdst)
+                return
+            except OSError as e:
+                # e.g. src and dst on different filesystems
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]: raise
+        shutil.copyfile(fsrc, fdst)
+        shutil.copystat(fsrc, fdst)
+    pool = ThreadPool(nthreads)
+    pool.map(copy, files[1:] if reflink else files)
+    pool.close()
+    logging.debug("Cloned "+src+": "+("reflinks" if reflink else str(len(links))+" files linked, "+str(len(files)-len(links))+" copied."))
+    return dst
 
 def add_coloring_to_emit_ansi(fn):
     # add methods we need to the class
@@ -37,15 +192,15 @@ def add_coloring_to_emit_ansi(fn):
         return fn(*args)
     return new
 
-def set_logger():
+def set_logger(filename='pipeline.logging'):
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
     # get rid of all other loggers imported by modules
     for l in logger.handlers: l.setLevel('ERROR')
     logging.StreamHandler.emit = add_coloring_to_emit_ansi(logging.StreamHandler.emit)
     # create file handler which logs even debug messages
-    check_rm('pipeline.logging')
-    fh = logging.FileHandler('pipeline.logging')
+    check_rm(filename)
+    fh = logging.FileHandler(filename)
     fh.setLevel(logging.DEBUG)
     # create console handler with a higher log level
     ch = logging.StreamHandler()
@@ -110,24 +265,461 @@ class Source(object):
         else:
             self.expnoise = 1.e-6
 
-def cleanmaskclean(parms, s, makemask=True):
+
+def _jsonStr(obj):
+    """Convert the unicode strings returned by json back to str (CASA tasks may reject unicode)
+    """
+    if isinstance(obj, unicode): return str(obj)
+    if isinstance(obj, list): return [_jsonStr(o) for o in obj]
+    if isinstance(obj, dict): return dict([(_jsonStr(k), _jsonStr(v)) for k, v in obj.items()])
+    return obj
+
+class StepRunner(object):
+    """Run the pipeline steps recording in a json checkpoint file the completed steps,
+    a fingerprint of their inputs and the state of the sources (ms, gaintables, interp),
+    so that a restarted run skips what is already done
+    checkpoint: checkpoint file name
+    sources: list of Source objects whose state is saved/restored
+    inputs: files whose content is part of every step fingerprint (e.g. the conf file)
+    restart_from: name of a step to rerun (with all following) even if completed
+    upstream: string added to every fingerprint (e.g. upstream() of the parent runner)
+    enabled: names of the steps to run, the others are skipped (None: all)
+    """
+    state_attrs = ['ms', 'gaintables', 'interp', 'images']
+
+    def __init__(self, checkpoint, sources, inputs=[], restart_from='', upstream='', enabled=None):
+        import json
+        self.checkpoint = checkpoint
+        self.sources = sources
+        self.inputs = inputs
+        self.restart_from = restart_from
+        self.upstream_fp = upstream
+        self.enabled = enabled
+        self.pos = 0 # position of the next step in the checkpoint
+        self.current = None
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f: self.cp = _jsonStr(json.load(f))
+            logging.info("Checkpoint found, completed steps: "+", ".join([st['name'] for st in self.cp['steps']]))
+        else:
+            self.cp = {'steps':[], 'partial':{}}
+
+    def _save(self):
+        import json
+        with open(self.checkpoint+'.tmp', 'w') as f: json.dump(self.cp, f, indent=1)
+        os.rename(self.checkpoint+'.tmp', self.checkpoint)
+
+    def _fingerprint(self, args):
+        import hashlib
+        h = hashlib.md5(repr(args)+self.upstream_fp)
+        for inp in self.inputs:
+            with open(inp) as f: h.update(f.read())
+        return h.hexdigest()
+
+    def run(self, step, *args):
+        """Run step(*args) unless it is already completed with the same inputs
+        """
+        name = step.__name__
+        steps = self.cp['steps']
+        if self.enabled is not None and not name in self.enabled:
+            logging.info("### SKIP "+name+" (not enabled)")
+            # keep the record of a previous run, so the following steps stay aligned
+            if self.pos < len(steps) and steps[self.pos]['name'] == name: self.pos += 1
+            return
+        fp = self._fingerprint(args)
+        if self.pos < len(steps) and steps[self.pos]['name'] == name and steps[self.pos]['fingerprint'] == fp \
+                and name != self.restart_from:
+            logging.info("### SKIP "+name+" (completed in a previous run)")
+            for s in self.sources:
+                for attr, value in steps[self.pos]['sources'].get(s.name, {}).items(): setattr(s, attr, value)
+            self.pos += 1
+            return
+
+        # this step and all the following must be redone, the progress of
+        # this step is kept only if it was interrupted with the same inputs
+        del steps[self.pos:]
+        partial = self.cp['partial'].get(name)
+        if partial is None or partial['fingerprint'] != fp or name == self.restart_from:
+            partial = {'fingerprint':fp, 'data':{}}
+        self.cp['partial'] = {name:partial}
+        self.current = name
+        self.restart_from = ''
+        self._save()
+
+        ret = step(*args)
+
+        state = {}
+        for s in self.sources:
+            state[s.name] = dict([(attr, getattr(s, attr)) for attr in self.state_attrs if hasattr(s, attr)])
+        steps.append({'name':name, 'fingerprint':fp, 'sources':state})
+        self.cp['partial'] = {}
+        self.pos += 1
+        self._save()
+        return ret
+
+    def upstream(self):
+        """Return a fingerprint of all the steps completed so far
+        """
+        return ','.join([st['fingerprint'] for st in self.cp['steps']])
+
+    def getPartial(self, key):
+        """Return the progress of the running step saved by an interrupted run (None if missing)
+        """
+        return self.cp['partial'].get(self.current, {}).get('data', {}).get(key)
+
+    def setPartial(self, key, value):
+        """Save the progress of the running step (e.g. the selfcal cycle of a source) to resume it
+        """
+        self.cp['partial'][self.current]['data'][key] = value
+        self._save()
+
+
+def runWorkers(jobs, ncpu, cmd):
+    """Run "cmd" once per job in at most "ncpu" parallel processes
+    jobs: list of dicts, each is passed json-encoded to its worker in the GMRTPIP_JOB env variable,
+    job['log'] is the file for the worker output and job['result'] the json file the worker must write
+    Return the list of decoded results (None for failed workers)
+    """
+    import subprocess, json, time
+    pending = list(enumerate(jobs))
+    running = {}
+    results = [None]*len(jobs)
+    while pending or running:
+        while pending and len(running) < ncpu:
+            i, job = pending.pop(0)
+            check_rm(job['result'])
+            env = dict(os.environ)
+            env['GMRTPIP_JOB'] = json.dumps(job)
+            log = open(job['log'], 'w')
+            running[i] = (subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT), log)
+            logging.info("Started worker "+str(i)+" (log: "+job['log']+")")
+        time.sleep(5)
+        for i, (p, log) in running.items():
+            if p.poll() is None: continue
+            log.close()
+            del running[i]
+            if os.path.exists(jobs[i]['result']):
+                with open(jobs[i]['result']) as f: results[i] = _jsonStr(json.load(f))
+                logging.info("Worker "+str(i)+" done.")
+            else:
+                logging.error("Worker "+str(i)+" failed (exit code: "+str(p.returncode)+"), see "+jobs[i]['log'])
+    return results
+
+
+def _bkgMaps(pix, box=100):
+    """Return background (median) and rms (MAD) maps of a 2D image, computed in
+    boxes of box x box pixels and linearly interpolated at each pixel, NaN are ignored
+    """
+    nx, ny = pix.shape
+    bx, by = -(-nx//box), -(-ny//box)
+    pad = np.empty((bx*box, by*box))
+    pad[:] = np.nan
+    pad[:nx,:ny] = pix
+    blocks = pad.reshape(bx, box, by, box).transpose(0,2,1,3).reshape(bx, by, box*box)
+    valid = blocks == blocks
+    med = _median_lastaxis(blocks, valid)
+    rms = 1.4826 * _median_lastaxis(np.abs(blocks - med[:,:,np.newaxis]), valid)
+    # boxes without data (or blank) get the median of the others
+    bad = np.logical_not(rms > 0)
+    if np.all(bad): return np.zeros_like(pix), np.ones_like(pix)
+    med[bad] = np.median(med[~bad])
+    rms[bad] = np.median(rms[~bad])
+    # bilinear interpolation from the box centres, one axis at a time
+    def interp(m):
+        xs, ys = (np.arange(nx)+0.5)/box-0.5, (np.arange(ny)+0.5)/box-0.5
+        tmp = np.array([np.interp(ys, np.arange(by), row) for row in m])
+        return np.array([np.interp(xs, np.arange(bx), col) for col in tmp.T]).T
+    return interp(med), interp(rms)
+
+def _islands(pix, threshpix, threshisl, box=100):
+    """Return the boolean mask of all the islands (pixels above threshisl sigma)
+    with a peak above threshpix sigma
+    """
+    from scipy import ndimage
+    bkg, rms = _bkgMaps(pix, box)
+    with np.errstate(invalid='ignore'):
+        snr = np.nan_to_num((pix - bkg) / rms)
+    labels, nisl = ndimage.label(snr > threshisl)
+    if nisl == 0: return np.zeros(pix.shape, dtype=bool)
+    peaks = ndimage.maximum(snr, labels, index=np.arange(1, nisl+1))
+    keep = np.concatenate([[False], peaks > threshpix])
+    return keep[labels]
+
+def makeMask(img, mask, threshpix=6, threshisl=3, atrous=False, nscales=4, box=100):
+    """Create a clean mask (1 on sources) from an image with island detection,
+    in-process replacement of make_mask.py
+    img: image to search for sources
+    mask: output mask image (same coordinates of img)
+    threshpix, threshisl: peak and island thresholds in units of the local rms
+    atrous: also detect islands on the a-trous wavelet scales (extended emission)
+    nscales: number of wavelet scales
+    box: size in pixels of the boxes for the background/rms maps
+    Return False if it cannot run (scipy missing)
+    """
+    try:
+        from scipy import ndimage
+    except ImportError:
+        return False
+
+    ia.open(img)
+    csys = ia.coordsys()
+    shape = ia.shape()
+    pix = ia.getchunk(blc=[0,0]+[0]*(len(shape)-2), trc=[shape[0]-1,shape[1]-1]+[0]*(len(shape)-2), dropdeg=False)
+    ia.close()
+    pix = pix.reshape(shape[0], shape[1])
+
+    m = _islands(pix, threshpix, threshisl, box)
+    if atrous:
+        # B3-spline a-trous decomposition, islands are searched on each scale
+        kern = np.array([1., 4., 6., 4., 1.])/16.
+        c = np.nan_to_num(pix)
+        for j in xrange(nscales):
+            k = np.zeros(4*2**j+1)
+            k[::2**j] = kern
+            cnext = ndimage.convolve1d(ndimage.convolve1d(c, k, axis=0, mode='reflect'), k, axis=1, mode='reflect')
+            m |= _islands(c - cnext, threshpix, threshisl, box)
+            c = cnext
+        # large scales detect the edges of extended sources
+        m = ndimage.binary_fill_holes(m)
+    logging.debug("Mask "+mask+": "+str(np.sum(m))+" pixels ("+str(100.*np.mean(m))+"%).")
+
+    ia.fromshape(outfile=mask, shape=shape, csys=csys.torecord(), overwrite=True)
+    csys.done()
+    # the (x, y) plane is replicated along the other axes
+    ia.putchunk(m.astype(np.float32).reshape(tuple(shape[0:2])+(1,)*(len(shape)-2)), replicate=True)
+    ia.close()
+    return True
+
+# cache of the MS properties used for planning: {(vis, mtime): (wmax, fracbw)}
+_msPlanCache = {}
+
+def _msPlanInfo(vis):
+    """Return max |w| (wavelengths) and fractional bandwidth of an MS
+    """
+    key = (os.path.abspath(vis), os.path.getmtime(os.path.join(vis, 'table.dat')))
+    if not key in _msPlanCache:
+        tbLoc = casac.table()
+        tbLoc.open(vis+'/SPECTRAL_WINDOW')
+        freqs = np.concatenate([tbLoc.getcell('CHAN_FREQ', i) for i in xrange(tbLoc.nrows())])
+        widths = np.concatenate([np.abs(tbLoc.getcell('CHAN_WIDTH', i)) for i in xrange(tbLoc.nrows())])
+        tbLoc.close()
+        fmin, fmax = np.min(freqs-widths/2.), np.max(freqs+widths/2.)
+        tbLoc.open(vis)
+        wmax = 0.
+        chunk = 1000000
+        for row in xrange(0, tbLoc.nrows(), chunk):
+            wmax = max(wmax, np.max(np.abs(tbLoc.getcol('UVW', startrow=row, nrow=chunk)[2])))
+        tbLoc.close()
+        _msPlanCache[key] = (wmax * fmax / 299792458., (fmax-fmin)/((fmax+fmin)/2.))
+    return _msPlanCache[key]
+
+def _goodSize(n):
+    """Smallest even number >= n with only 2, 3 and 5 as factors (fast FFT)
+    """
+    n = int(np.ceil(n))
+    while True:
+        m = n
+        for f in [2, 3, 5]:
+            while m % f == 0: m //= f
+        if m == 1 and n % 2 == 0: return n
+        n += 1
+
+def wprojPlanes(vis, imsize, cell, dphi=0.1, maxplanes=512):
+    """Number of w-projection planes so that the w-term phase error at the image
+    corner is below dphi (rad) in each plane, 0 if the w-term is negligible
+    vis: MS
+    imsize: image size in pixels (int or [x,y])
+    cell: pixel size (quantity string or list, e.g. '1arcsec')
+    maxplanes: upper limit (time and memory of the convolution functions), dphi is
+    not met above it
+    """
+    if type(imsize) is list: imsize = max(imsize)
+    if type(cell) is list: cell = cell[0]
+    wmax, fracbw = _msPlanInfo(vis)
+    theta = imsize * qa.convert(qa.quantity(cell), 'rad')['value']
+    r2 = 2*(theta/2.)**2 # corner
+    nplanes = int(np.ceil(np.pi * wmax * r2 / dphi))
+    if nplanes <= 1: return 0
+    if nplanes > maxplanes:
+        logging.warning("W-projection: "+str(nplanes)+" planes needed for a phase error of "+str(dphi)+" rad, using "+ \
+            str(maxplanes)+" (phase error %.2f rad)." % (np.pi * wmax * r2 / maxplanes))
+        return maxplanes
+    return nplanes
+
+def planImaging(parms, dphi=0.1, dr=1000., alpha=0.8, maxplanes=512):
+    """Set in a clean parameter dict the cheapest wprojplanes (and gridmode), imsize
+    and nterms which meet the required accuracy, the dict is modified and returned
+    wprojplanes and nterms already in the dict are kept
+    dphi, maxplanes: max w-term phase error (rad) per w-plane and max number of planes, see wprojPlanes()
+    dr: target dynamic range, nterms=2 is used if a spectral index "alpha"
+    across the band would limit it
+    """
+    imsize = parms['imsize']
+    if type(imsize) is list: parms['imsize'] = [_goodSize(i) for i in imsize]
+    else: parms['imsize'] = _goodSize(imsize)
+
+    if 'wprojplanes' in parms: nplanes = parms['wprojplanes']
+    else: nplanes = wprojPlanes(parms['vis'], parms['imsize'], parms['cell'], dphi, maxplanes)
+    if nplanes == 0:
+        parms['gridmode'] = ''
+        parms.pop('wprojplanes', None)
+    else:
+        parms['gridmode'] = 'widefield'
+        parms['wprojplanes'] = nplanes
+
+    # rms of a linear spectral slope over the band
+    if not 'nterms' in parms:
+        wmax, fracbw = _msPlanInfo(parms['vis'])
+        if alpha * fracbw / (2*np.sqrt(3.)) > 1./dr: parms['nterms'] = 2
+        else: parms['nterms'] = 1
+
+    logging.debug("Imaging plan for "+parms['imagename']+": imsize="+str(parms['imsize'])+", wprojplanes="+ \
+        str(parms.get('wprojplanes', 0))+", nterms="+str(parms['nterms']))
+    return parms
+
+def imgName(imagename, nterms, ext='image'):
+    """Name of the clean product "ext" (image, model, residual...) of the first Taylor term
+    """
+    if nterms > 1: return imagename+'.'+ext+'.tt0'
+    return imagename+'.'+ext
+
+def modelNames(imagename, nterms):
+    """List of the model images of a clean (one per Taylor term)
+    """
+    if nterms > 1: return [imagename+'.model.tt'+str(i) for i in xrange(nterms)]
+    return [imagename+'.model']
+
+# cache of the MS layout hashes: {(vis, fingerprint): hash}
+_msLayoutCache = {}
+
+def _msLayoutHash(vis, memlimit=512):
+    """Return a hash of what ftw() predicts visibilities for: rows (time, baseline,
+    uvw, spw, field), channel frequencies, correlations and phase centres
+    """
+    import hashlib
+    cols = ['TIME', 'UVW', 'ANTENNA1', 'ANTENNA2', 'DATA_DESC_ID', 'FIELD_ID']
+    subtabs = ['SPECTRAL_WINDOW', 'DATA_DESCRIPTION', 'POLARIZATION', 'FIELD']
+    files = _dmFiles(vis, cols) + [os.path.join(vis, t, 'table.f0') for t in subtabs]
+    fingerprint = tuple(sorted([(f, os.path.getsize(f), os.path.getmtime(f)) for f in files if os.path.exists(f)]))
+    key = (os.path.abspath(vis), fingerprint)
+    if not key in _msLayoutCache:
+        md5 = hashlib.md5()
+        tbLoc = casac.table()
+        for t, tcols in zip(subtabs, [['CHAN_FREQ'], ['SPECTRAL_WINDOW_ID', 'POLARIZATION_ID'], ['CORR_TYPE'], ['PHASE_DIR']]):
+            tbLoc.open(vis+'/'+t)
+            for i in xrange(tbLoc.nrows()):
+                for c in tcols: md5.update(np.asarray(tbLoc.getcell(c, i)).tostring())
+            tbLoc.close()
+        tbLoc.open(vis)
+        chunk = max(1, int(memlimit*1024**2/64))
+        for row in xrange(0, tbLoc.nrows(), chunk):
+            for c in cols: md5.update(tbLoc.getcol(c, startrow=row, nrow=chunk).tostring())
+        tbLoc.close()
+        _msLayoutCache[key] = md5.hexdigest()
+    return _msLayoutCache[key]
+
+def _modelHash(model, blockmem=64):
+    """Return a hash of pixels and coordinates of a list of model images
+    """
+    import hashlib
+    md5 = hashlib.md5()
+    for img in model:
+        ia.open(img)
+        shape = ia.shape()
+        csys = ia.coordsys()
+        md5.update(repr((list(shape), list(csys.referencevalue()['numeric']), list(csys.increment()['numeric']), \
+            list(csys.referencepixel()['numeric']))))
+        nrows = max(1, int(blockmem*1024**2/(8*shape[0]*np.prod(shape[2:]))))
+        for y0 in xrange(0, shape[1], nrows):
+            y1 = min(y0+nrows, shape[1])-1
+            md5.update(ia.getchunk(blc=[0, y0], trc=[shape[0]-1, y1]).tostring())
+        csys.done()
+        ia.close()
+    return md5.hexdigest()
+
+def ftModel(vis, model, wprojplanes=0, cachedir='', cachesize=20000, memlimit=1024):
+    """Fill MODEL_DATA of "vis" with the prediction of "model" (ftw with usescratch),
+    predicted visibilities are stored in "cachedir" and reused for the same model,
+    MS layout and wprojplanes instead of predicting again
+    model: list of model images (one per Taylor term)
+    cachedir: dir of the cache (default: '' no cache)
+    cachesize: max size (MB) of the cache
+    memlimit: max memory (MB) used to copy the visibilities at once
+    """
+    if type(model) is str: model = [model]
+    tbLoc = casac.table()
+    tbLoc.open(vis+'/SPECTRAL_WINDOW')
+    nchan = set(tbLoc.getcol('NUM_CHAN'))
+    tbLoc.close()
+    tbLoc.open(vis+'/POLARIZATION')
+    ncorr = set(tbLoc.getcol('NUM_CORR'))
+    tbLoc.close()
+    # cache only MSs with a fixed shape MODEL_DATA
+    if cachedir == '' or len(nchan) > 1 or len(ncorr) > 1:
+        default('ftw')
+        ftw(vis=vis, model=model, nterms=len(model), wprojplanes=wprojplanes, usescratch=True)
+        return
+    nchan, ncorr = nchan.pop(), ncorr.pop()
+
+    import hashlib
+    key = hashlib.md5(repr((_modelHash(model), _msLayoutHash(vis), wprojplanes))).hexdigest()
+    modelfile = os.path.join(cachedir, 'model-'+key+'.npy')
+
+    tbLoc.open(vis, nomodify=False)
+    nrows = tbLoc.nrows()
+    chunk = max(1, int(memlimit*1024**2/(8*ncorr*nchan)))
+    mm = None
+    if os.path.exists(modelfile) and 'MODEL_DATA' in tbLoc.colnames():
+        # may be evicted meanwhile by a concurrent process
+        try:
+            os.utime(modelfile, None) # LRU
+            mm = np.load(modelfile, mmap_mode='r')
+        except (OSError, IOError): pass
+    if mm is not None:
+        logging.debug("Model visibilities from cache: "+modelfile)
+        for row in xrange(0, nrows, chunk):
+            tbLoc.putcol('MODEL_DATA', np.array(mm[row:row+chunk].T), startrow=row, nrow=chunk)
+        tbLoc.close()
+        return
+    tbLoc.close()
+
+    default('ftw')
+    ftw(vis=vis, model=model, nterms=len(model), wprojplanes=wprojplanes, usescratch=True)
+
+    if not os.path.exists(cachedir): os.makedirs(cachedir)
+    # write to a hidden file then rename, so partial predictions are never reused
+    tmpfile = os.path.join(cachedir, '.model-'+key+'-'+str(os.getpid())+'.npy')
+    mm = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.complex64, shape=(nrows, nchan, ncorr))
+    tbLoc.open(vis)
+    for row in xrange(0, nrows, chunk):
+        mm[row:row+chunk] = tbLoc.getcol('MODEL_DATA', startrow=row, nrow=chunk).T
+    tbLoc.close()
+    del mm
+    os.rename(tmpfile, modelfile)
+    _cacheEvict(cachedir, cachesize, keep=modelfile)
+
+def cleanmaskclean(parms, s, makemask=True, plan={}):
     """
     Clean then make a mask and clean again
     parms: dict of parameters for the clean task
     makemask: if false quit after first clean
+    plan: choose wprojplanes, imsize and nterms with planImaging(), a dict is passed
+    to it as arguments (dphi, dr, alpha), None to use parms as they are
+    parms is updated with the values used (imagename of the masked clean if makemask)
     """
+    if plan is not None: planImaging(parms, **plan)
     default('clean')
     clean(**parms)
     if not makemask: return
 
     # make mask and re-do image
-    if parms['nterms'] > 1: img = parms['imagename']+'.image.tt0'
-    else: img = parms['imagename']+'.image'
+    img = imgName(parms['imagename'], parms['nterms'])
 
-    if s.extended:
-        os.system(pipdir+'/setpp.sh make_mask.py '+img+' -m'+parms['imagename']+'.newmask --threshpix=6 --threshisl=3 --atrous_do')
-    else:
-        os.system(pipdir+'/setpp.sh make_mask.py '+img+' -m'+parms['imagename']+'.newmask --threshpix=6 --threshisl=3')
+    # fall back on the external make_mask.py if the native masking fails
+    if not makeMask(img, parms['imagename']+'.newmask', threshpix=6, threshisl=3, atrous=s.extended):
+        if s.extended:
+            os.system(pipdir+'/setpp.sh make_mask.py '+img+' -m'+parms['imagename']+'.newmask --threshpix=6 --threshisl=3 --atrous_do')
+        else:
+            os.system(pipdir+'/setpp.sh make_mask.py '+img+' -m'+parms['imagename']+'.newmask --threshpix=6 --threshisl=3')
 
     if s.mask_faint != '':
         parms['mask']=[parms['imagename']+'.newmask',s.mask_faint]
@@ -138,11 +730,198 @@ def cleanmaskclean(parms, s, makemask=True):
     parms['niter']=parms['niter']/3 # reduce number if clean iterations in masked mode
     default('clean')
     clean(**parms)
-   
-def clipresidual(active_ms, f='', s=''):
+
+def _median_lastaxis(a, valid):
+    """Median along the last axis considering only the "valid" elements
+    a: data array (any number of dims)
+    valid: boolean array of the same shape of a
+    Return an array with the shape of a[...,0], NaN where nothing is valid
+    """
+    a = np.where(valid, a, np.nan).reshape(-1, a.shape[-1])
+    a.sort(axis=1) # NaNs are sorted at the end
+    n = np.sum(a == a, axis=1)
+    rows = np.arange(a.shape[0])
+    lo = a[rows, np.maximum(n-1, 0)//2]
+    hi = a[rows, n//2 - (n == 0)] # stay in range when empty
+    med = (lo + hi)/2.
+    med[n == 0] = np.nan
+    return med.reshape(valid.shape[:-1])
+
+def _weighted_median(vals, wts):
+    """Weighted median along the first axis
+    vals, wts: arrays of shape (n, ...), elements with weight 0 are ignored
+    Return an array of shape vals.shape[1:], NaN where the total weight is 0
+    """
+    shape = vals.shape[1:]
+    vals = np.where(wts > 0, vals, np.inf).reshape(vals.shape[0], -1)
+    wts = wts.reshape(vals.shape)
+    order = np.argsort(vals, axis=0)
+    cols = np.arange(vals.shape[1])
+    cw = np.cumsum(wts[order, cols], axis=0)
+    idx = np.minimum(np.sum(cw < cw[-1]/2., axis=0), vals.shape[0]-1)
+    med = vals[order[idx, cols], cols].astype(float)
+    med[cw[-1] == 0] = np.nan
+    return med.reshape(shape)
+
+class RunningMedian(object):
+    """Bounded-memory estimate of the per-baseline median along time
+    of a (corr, chan, bl) cube which is read in time chunks.
+    Every chunk contributes with its exact median weighted by the number of
+    valid samples, when the buffer is full it is collapsed into its weighted median.
+    """
+    def __init__(self, shape, nbuf=8):
+        self.vals = np.zeros((nbuf,)+shape, dtype=np.float32)
+        self.wts = np.zeros((nbuf,)+shape, dtype=np.int32)
+        self.used = np.zeros(shape, dtype=bool) # BLs with some unflagged data
+        self.n = 0
+
+    def add(self, amp, flag, bl):
+        """amp, flag: arrays of shape (corr, chan, bl, time)
+        bl: index of each baseline of the chunk in the cube
+        """
+        if self.n == len(self.vals): self._collapse()
+        unflagged = ~flag
+        valid = unflagged & (amp == amp)
+        self.wts[self.n] = 0
+        self.vals[self.n][:,:,bl] = _median_lastaxis(amp, valid)
+        self.wts[self.n][:,:,bl] = np.sum(valid, axis=-1)
+        self.used[:,:,bl] |= np.any(unflagged, axis=-1)
+        self.n += 1
+
+    def _collapse(self):
+        tot = np.sum(self.wts, axis=0)
+        self.vals[0] = _weighted_median(self.vals, self.wts)
+        self.wts[:] = 0
+        self.wts[0] = tot
+        self.n = 1
+
+    def median(self):
+        return _weighted_median(self.vals[:self.n], self.wts[:self.n])
+
+def _bl_index(ant1, ant2, nant):
+    """Index of the baselines (autocorr included) in the upper triangle
+    of the nant x nant matrix, same order of np.triu_indices(nant)
+    """
+    a1 = np.minimum(ant1, ant2)
+    a2 = np.maximum(ant1, ant2)
+    return a1*nant - a1*(a1-1)//2 + a2 - a1
+
+def _find_outlier_bl(amp, flag):
+    """Find baselines with median residuals outside 3 rms of the distribution of medians
+    amp, flag: arrays of shape (corr, chan, bl, time)
+    Return a boolean array of shape (corr, chan, bl), True for baselines to flag
+    """
+    unflagged = ~flag
+    meds = _median_lastaxis(amp, unflagged & (amp == amp))
+    return _outlier_bl(meds, np.any(unflagged, axis=-1))
+
+def _outlier_bl(meds, used):
+    """Flag decision from the per-baseline medians
+    meds: median of the unflagged data, shape (corr, chan, bl)
+    used: baselines with some unflagged data, they enter the statistics
+    (those with only NaNs contribute with a NaN, which prevents flagging)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.sum(used, axis=-1)
+        med = np.sum(np.where(used, meds, 0.), axis=-1) / n
+        rms = np.sqrt( np.sum(np.where(used, (meds - med[...,np.newaxis])**2, 0.), axis=-1) / n )
+        # if BL residuals are 3 times out of med rms, flag
+        return used & ( np.abs(meds - med[...,np.newaxis]) > 3*rms[...,np.newaxis] )
+
+def _chunk_interval(integ, bytes_per_time, memlimit):
+    """Length (s) of the time chunks to keep in memory less than memlimit MB
+    integ: integration time (s)
+    bytes_per_time: memory needed for each timestamp
+    """
+    ntimes = max(1, int(memlimit*1024.**2 / bytes_per_time))
+    return (ntimes - 0.5)*integ
+
+def _selectDataDesc(datadescid, f='', s=''):
+    """Restrict the open ms tool to a single datadesc (required by getdata
+    with ifraxis) and then to field "f" and scan "s", dropping previous selections
+    """
+    ms.selectinit(reset=True)
+    ms.selectinit(datadescid=datadescid)
+    ms.msselect({'field':f, 'scan':s})
+
+def _clipresidual_stream(active_ms, f, s, memlimit):
+    """Streaming version of the clipping in clipresidual(), the MS is read
+    in time chunks and the per-baseline medians are estimated from the chunk medians
+    memlimit: memory (MB) for the data of each chunk
+    """
+    tb.open(active_ms)
+    integ = tb.getcell('INTERVAL', 0)
+    tb.close()
+    ms.open(active_ms, nomodify=False)
+    metadata = ms.metadata()
+    nant = metadata.nantennas()
+    nbl = nant*(nant+1)//2
+    antnames = metadata.antennanames()
+    a1, a2 = np.triu_indices(nant)
+    flag = {}
+    for datadescid in metadata.datadescids():
+        logging.debug("Working on datadesc: "+str(datadescid))
+        ncorr = metadata.ncorrforpol(metadata.polidfordatadesc(datadescid))
+        nchan = metadata.nchan(metadata.spwfordatadesc(datadescid))
+        # amp, flag, the NaN-filled copy and the sort (~20 bytes per sample)
+        interval = _chunk_interval(integ, 20*ncorr*nchan*nbl, memlimit)
+        runmed = RunningMedian((ncorr, nchan, nbl))
+        _selectDataDesc(datadescid, f, s)
+        ms.iterinit(columns=['TIME'], interval=interval)
+        ms.iterorigin()
+        while True:
+            d = ms.getdata(['corrected_amplitude','flag','antenna1','antenna2'], ifraxis=True)
+            runmed.add(d['corrected_amplitude'], d['flag'], _bl_index(d['antenna1'], d['antenna2'], nant))
+            if not ms.iternext(): break
+        ms.iterend()
+        flag[datadescid] = _outlier_bl(runmed.median(), runmed.used)
+        del runmed
+        for corr, chan, bl in zip(*np.where(flag[datadescid])):
+            logging.debug("Flagging corr: "+str(corr)+" - chan:"+str(chan)+" - BL: "+antnames[a1[bl]]+"-"+antnames[a2[bl]])
+    ms.close()
+
+    _extend_blflags(active_ms, flag, nant, memlimit)
+
+def _extend_blflags(active_ms, flag, nant, memlimit=1024):
+    """Extend the per-baseline flag decisions to all the times of the MS
+    flag: dict of boolean arrays of shape (corr, chan, bl) for each datadesc,
+    with bl as in _bl_index()
+    memlimit: memory (MB) for the flags of each time chunk,
+    only the chunks where some flag actually changes are written back
+    """
+    nbl = nant*(nant+1)//2
+    tb.open(active_ms)
+    integ = tb.getcell('INTERVAL', 0)
+    tb.close()
+    ms.open(active_ms, nomodify=False)
+    for datadescid in flag:
+        if not flag[datadescid].any(): continue
+        ncorr, nchan = flag[datadescid].shape[:2]
+        interval = _chunk_interval(integ, 2*ncorr*nchan*nbl, memlimit)
+        nchunks = nwritten = 0
+        _selectDataDesc(datadescid)
+        ms.iterinit(columns=['TIME'], interval=interval)
+        ms.iterorigin()
+        while True:
+            nchunks += 1
+            w = ms.getdata(['flag','antenna1','antenna2'], ifraxis=True)
+            blflag = flag[datadescid][:,:,_bl_index(w['antenna1'], w['antenna2'], nant)]
+            # broadcast the (corr, chan, bl) decision over time
+            newflag = w['flag'] | blflag[...,np.newaxis]
+            if np.any(newflag != w['flag']):
+                ms.putdata({'flag':newflag})
+                nwritten += 1
+            if not ms.iternext(): break
+        ms.iterend()
+        logging.debug("Datadesc "+str(datadescid)+": written flags for "+str(nwritten)+" of "+str(nchunks)+" time chunks.")
+    ms.close()
+
+def clipresidual(active_ms, f='', s='', memlimit=0):
     """Create residuals in the CORRECTED_DATA (then unusable!)
     and clip at 5 times the total flux of the model
     NOTE: the ms CORRECTED_DATA will be corrupted!
+    memlimit: if >0 the MS is streamed in time chunks using at most
+    this memory (MB) for the data, independently of the observation length
     """
 
     default('uvsub')
@@ -152,63 +931,164 @@ def clipresidual(active_ms, f='', s=''):
     statsFlag(active_ms, note='Before BL flag')
 
     logging.debug("Removing baselines with high residuals:")
-    import itertools
+    if memlimit > 0:
+        _clipresidual_stream(active_ms, f, s, memlimit)
+        flagsChanged(active_ms)
+        statsFlag(active_ms, note='After clipping')
+        return
+
     ms.open(active_ms, nomodify=False)
     metadata = ms.metadata()
+    nant = metadata.nantennas()
     flag = {}
     # datadesc ids are usually one per spw, but ms can also be splitted in corr
     for datadescid in metadata.datadescids():
-        flag[datadescid] = {}
         logging.debug("Working on datadesc: "+str(datadescid))
-        ms.msselect({'field':f, 'scan':s})
+        _selectDataDesc(datadescid, f, s)
         d = ms.getdata(['corrected_amplitude','flag','antenna1','antenna2','axis_info'], ifraxis=True)
-        # cycle on corr
-        for corr in xrange(len(d['corrected_amplitude'])):
-            flag[datadescid][corr] = {}
-            logging.debug("Working on corr: "+d['axis_info']['corr_axis'][corr])
-            # cycle on channels
-            for chan in xrange(len(d['corrected_amplitude'][corr])):
-                flag[datadescid][corr][chan] = {}
-                meds = []
-                # cycle on bl
-                for bl in xrange(len(d['corrected_amplitude'][corr][chan])):
-                    amp = d['corrected_amplitude'][corr][chan][bl][~d['flag'][corr][chan][bl]] # get unflagged data
-                    if amp != []: meds.append(np.median( amp[(amp == amp)] ))
-                med = np.mean(meds)
-                rms = np.std(meds)
-                for bl in xrange(len(d['corrected_amplitude'][corr][chan])):
-                    flag[datadescid][corr][chan][bl] = False
-                    amp = d['corrected_amplitude'][corr][chan][bl][~d['flag'][corr][chan][bl]] # get unflagged data
-                    if amp != []: 
-                        bl_med = np.median( amp[(amp == amp)] )
-                        # if BL residuals are 3 times out of med rms, flag
-                        if abs(bl_med - med) > 3*rms:
-                            logging.debug("Flagging corr: "+d['axis_info']['corr_axis'][corr]+" - chan:"+str(chan)+" - BL: "+d['axis_info']['ifr_axis']['ifr_name'][bl])
-                            flag[datadescid][corr][chan][bl] = True
+        # per-baseline medians for all corr and chan at once, shape is (corr, chan, bl)
+        blflag = _find_outlier_bl(d['corrected_amplitude'], d['flag'])
+        for corr, chan, bl in zip(*np.where(blflag)):
+            logging.debug("Flagging corr: "+d['axis_info']['corr_axis'][corr]+" - chan:"+str(chan)+" - BL: "+d['axis_info']['ifr_axis']['ifr_name'][bl])
+        # the baselines of this selection may differ from those of the whole MS
+        flag[datadescid] = np.zeros(blflag.shape[:2]+(nant*(nant+1)//2,), dtype=bool)
+        flag[datadescid][:,:,_bl_index(d['antenna1'], d['antenna2'], nant)] = blflag
     ms.close()
 
     # extend flags to all scans
-    ms.open(active_ms, nomodify=False)
-    metadata = ms.metadata()
-    # datadesc ids are usually one per spw, but ms can also be splitted in corr
-    for datadescid in metadata.datadescids():
-        ms.msselect()
-        w = ms.getdata(['flag'], ifraxis=True)
-        for corr in xrange(len(w['flag'])):
-            # TODO: extend flags on all chan for BLs which appear often
-            for chan in xrange(len(w['flag'][corr])):
-                for bl in xrange(len(w['flag'][corr][chan])):
-                    if flag[datadescid][corr][chan][bl] == True:
-                        w['flag'][corr][chan][bl] = True
-        ms.putdata({'flag':w['flag']})
-    ms.close()
+    _extend_blflags(active_ms, flag, nant)
+    flagsChanged(active_ms)
 
     statsFlag(active_ms, note='After clipping')
 
 
-def statsFlag(active_ms, field='', scan='', note=''):
-    default('flagdata')
-    t = flagdata(vis=active_ms, mode='summary', field=field, scan=scan, action='calculate')
+# cache of flag summaries: {key: summary}
+_flagSummaryCache = {}
+
+def flagSummary(vis, field='', scan='', spw='', intent=''):
+    """Return the flagdata summary (per antenna, correlation, spw, field) of "vis"
+    computing it only if the flags changed since the last call (see flagsChanged())
+    the returned dict is shared, do not modify it
+    """
+    sel = [','.join(x) if isinstance(x, list) else str(x) for x in [field, scan, spw, intent]]
+    key = (os.path.abspath(vis),) + tuple(sel) + (_flagFingerprint(vis),)
+    if not key in _flagSummaryCache:
+        t = None
+        if sel[3] == '': t = _flagSummaryNative(vis, field=sel[0], scan=sel[1], spw=sel[2])
+        if t is None:
+            default('flagdata')
+            t = flagdata(vis=vis, mode='summary', field=sel[0], scan=sel[1], \
+                spw=sel[2], intent=sel[3], action='calculate')
+        _flagSummaryCache[key] = t
+    else: logging.debug("Flag summary from cache.")
+    return _flagSummaryCache[key]
+
+def _parseIds(sel):
+    """Parse a numeric selection like '0,2~4' into a list of ids
+    return [] for no selection and None if not numeric (e.g. names or channels)
+    """
+    ids = []
+    for item in filter(None, sel.replace(' ','').split(',')):
+        r = item.split('~')
+        if not all([i.isdigit() for i in r]) or len(r) > 2: return None
+        ids += range(int(r[0]), int(r[-1])+1)
+    return ids
+
+def _flagSummaryNative(vis, field='', scan='', spw='', memlimit=512):
+    """Count flags per antenna, correlation, spw, field and scan reading the FLAG
+    column in tiles of at most "memlimit" MB, return a dict like the flagdata summary
+    return None if the selection is not simply numeric (flagdata must be used)
+    """
+    fields, scans, spws = _parseIds(field), _parseIds(scan), _parseIds(spw)
+    if fields is None or scans is None or spws is None: return None
+
+    tbLoc = casac.table()
+    tbLoc.open(vis+'/ANTENNA')
+    # upper case as in RefAntGeometry, so the names can be matched
+    antnames = [name.upper() for name in tbLoc.getcol('NAME')]
+    tbLoc.close()
+    tbLoc.open(vis+'/FIELD')
+    fieldnames = tbLoc.getcol('NAME')
+    tbLoc.close()
+    tbLoc.open(vis+'/POLARIZATION')
+    corrtypes = [tbLoc.getcell('CORR_TYPE', i) for i in xrange(tbLoc.nrows())]
+    tbLoc.close()
+    tbLoc.open(vis+'/DATA_DESCRIPTION')
+    ddspw = tbLoc.getcol('SPECTRAL_WINDOW_ID')
+    ddpol = tbLoc.getcol('POLARIZATION_ID')
+    tbLoc.close()
+    # Stokes enum of casacore
+    stokes = {5:'RR', 6:'RL', 7:'LR', 8:'LL', 9:'XX', 10:'XY', 11:'YX', 12:'YY', 1:'I', 2:'Q', 3:'U', 4:'V'}
+
+    nant, nfield = len(antnames), len(fieldnames)
+    cnt = {'antenna':np.zeros((2,nant)), 'field':np.zeros((2,nfield)), 'spw':{}, 'correlation':{}, 'scan':{}}
+    tbLoc.open(vis)
+    for ddid in xrange(len(ddspw)):
+        if spws != [] and not ddspw[ddid] in spws: continue
+        query = 'DATA_DESC_ID=='+str(ddid)
+        if fields != []: query += ' && FIELD_ID IN '+str(fields)
+        if scans != []: query += ' && SCAN_NUMBER IN '+str(scans)
+        t = tbLoc.query(query)
+        nrows = t.nrows()
+        if nrows == 0:
+            t.close()
+            continue
+        corrs = [stokes.get(c, str(c)) for c in corrtypes[ddpol[ddid]]]
+        ncorr, nchan = t.getcell('FLAG', 0).shape
+        chunk = max(1, int(memlimit*1024**2/(ncorr*nchan)))
+        for row in xrange(0, nrows, chunk):
+            f = t.getcol('FLAG', startrow=row, nrow=chunk)
+            ant1 = t.getcol('ANTENNA1', startrow=row, nrow=chunk)
+            ant2 = t.getcol('ANTENNA2', startrow=row, nrow=chunk)
+            fieldid = t.getcol('FIELD_ID', startrow=row, nrow=chunk)
+            scanid = t.getcol('SCAN_NUMBER', startrow=row, nrow=chunk)
+            fcorr = np.sum(f, axis=1) # (corr, row)
+            frow = np.sum(fcorr, axis=0)
+            n = len(frow)
+            tot = ncorr*nchan
+            # autocorrelations count once for their antenna
+            cross = ant1 != ant2
+            for c, w in enumerate([frow, np.repeat(tot, n)]):
+                cnt['antenna'][c] += np.bincount(ant1, weights=w, minlength=nant) + \
+                    np.bincount(ant2[cross], weights=w[cross], minlength=nant)
+                cnt['field'][c] += np.bincount(fieldid, weights=w, minlength=nfield)
+            scanf = np.bincount(scanid, weights=frow)
+            scant = np.bincount(scanid)*tot
+            for sc in np.nonzero(scant)[0]:
+                v = cnt['scan'].setdefault(str(sc), [0, 0])
+                v[0] += scanf[sc]; v[1] += scant[sc]
+            for c, corr in enumerate(corrs):
+                v = cnt['correlation'].setdefault(corr, [0, 0])
+                v[0] += np.sum(fcorr[c]); v[1] += n*nchan
+            v = cnt['spw'].setdefault(str(ddspw[ddid]), [0, 0])
+            v[0] += np.sum(frow); v[1] += n*tot
+        t.close()
+    tbLoc.close()
+
+    summary = {'name':'Summary', 'type':'summary'}
+    summary['antenna'] = dict([(antnames[a], {'flagged':cnt['antenna'][0,a], 'total':cnt['antenna'][1,a]}) \
+        for a in np.nonzero(cnt['antenna'][1])[0]])
+    summary['field'] = dict([(fieldnames[f], {'flagged':cnt['field'][0,f], 'total':cnt['field'][1,f]}) \
+        for f in np.nonzero(cnt['field'][1])[0]])
+    for k in ['spw', 'correlation', 'scan']:
+        summary[k] = dict([(name, {'flagged':float(v[0]), 'total':float(v[1])}) for name, v in cnt[k].items()])
+    summary['flagged'] = float(sum([v['flagged'] for v in summary['spw'].values()]))
+    summary['total'] = float(sum([v['total'] for v in summary['spw'].values()]))
+    return summary
+
+def _debugEmitted():
+    """True if a DEBUG message would be written by some handler
+    """
+    logger = logging.getLogger()
+    return logger.isEnabledFor(logging.DEBUG) and \
+        any([h.level <= logging.DEBUG for h in logger.handlers])
+
+def statsFlag(active_ms, field='', scan='', note='', lazy=True):
+    """Log the flag statistics of active_ms
+    lazy: do nothing if the DEBUG log would be discarded anyway
+    """
+    if lazy and not _debugEmitted(): return
+    t = flagSummary(active_ms, field=field, scan=scan)
     #clearstat()
     log = 'Flag statistics ('+note+'):'
     log += '\nAntenna, '
@@ -224,34 +1104,162 @@ def statsFlag(active_ms, field='', scan='', note=''):
     logging.debug(log.replace(' - \n','\n'))
 
 
-def FlagCal(caltable, sigma = 5, cycles = 3):
-    """Flag sol outside n sigmas
-    Better high number of cycles (3) at high sigma (5)
+def _flagcal_arrays(pars, flags, ants, sigma=5, cycles=3, stat='mean'):
+    """Flag, for each antenna, solutions outside n sigmas
+    pars, flags: arrays of shape (pol, chan, row) as read from the caltable
+    ants: antenna of each row
+    stat: 'mean' to use mean/std or 'median' to use median/MAD (robust)
+    Return the new flags
     """
-    tb.open(caltable, nomodify=False)
+    if len(ants) == 0: return flags
+    # sort once by antenna so that each antenna is a contiguous slice
+    order = np.argsort(ants, kind='mergesort')
+    p = pars[:,:,order]
+    f = flags[:,:,order]
+    sants = ants[order]
+    starts = np.flatnonzero(np.r_[True, sants[1:] != sants[:-1]])
+    counts = np.diff(np.r_[starts, len(sants)])
+    grp = np.repeat(np.arange(len(starts)), counts) # antenna group of each row
+    for c in xrange(cycles):
+        good = np.logical_not(f)
+        if stat == 'median':
+            centre = np.zeros(len(starts), dtype=p.dtype)
+            spread = np.zeros(len(starts))
+            for g, (start, count) in enumerate(zip(starts, counts)):
+                v = p[:,:,start:start+count][good[:,:,start:start+count]]
+                if len(v) == 0: # all flagged antenna
+                    centre[g] = spread[g] = np.nan
+                    continue
+                if np.iscomplexobj(v): centre[g] = np.median(v.real) + 1j*np.median(v.imag)
+                else: centre[g] = np.median(v)
+                spread[g] = 1.4826 * np.median(np.abs(v - centre[g]))
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                n = np.add.reduceat(np.sum(good, axis=(0,1)), starts)
+                centre = np.add.reduceat(np.sum(np.where(good, p, 0), axis=(0,1)), starts) / n
+                dev2 = np.abs(p - centre[grp])**2
+                spread = np.sqrt( np.add.reduceat(np.sum(np.where(good, dev2, 0), axis=(0,1)), starts) / n )
+        # all flagged antennas have NaN stats and are left untouched
+        with np.errstate(invalid='ignore'):
+            f |= np.abs(p - centre[grp]) > sigma * spread[grp]
+    newflags = np.empty_like(flags)
+    newflags[:,:,order] = f
+    return newflags
+
+def _getcolpad(tbtool, col, fill, nchan=False):
+    """Like getcol() but also for columns with varying shape (e.g. spws with
+    different number of channels): rows are concatenated in a single
+    (pol, chan, row) buffer padded up to the largest shape with "fill"
+    nchan: if True return also the number of real channels of each row
+    """
+    if not tbtool.isvarcol(col):
+        buf = tbtool.getcol(col)
+        if nchan: return buf, np.repeat(buf.shape[1], buf.shape[2])
+        return buf
+    rows = tbtool.getvarcol(col)
+    shapes = np.array([rows['r'+str(i+1)].shape for i in xrange(len(rows))])
+    npol, maxchan = np.max(shapes[:,0]), np.max(shapes[:,1])
+    # each row is a (pol, chan, 1) array; flatten them once and scatter into the buffer
+    flat = np.concatenate([rows['r'+str(i+1)].ravel(order='F') for i in xrange(len(rows))])
+    rowidx = np.repeat(np.arange(len(rows)), shapes[:,0]*shapes[:,1])
+    offset = np.arange(len(flat)) - np.repeat(np.cumsum(shapes[:,0]*shapes[:,1]) - shapes[:,0]*shapes[:,1], shapes[:,0]*shapes[:,1])
+    npolrow = np.repeat(shapes[:,0], shapes[:,0]*shapes[:,1])
+    buf = np.empty((npol, maxchan, len(rows)), dtype=flat.dtype)
+    buf[:] = fill
+    buf[offset % npolrow, offset // npolrow, rowidx] = flat
+    if nchan: return buf, shapes[:,1]
+    return buf
+
+def readCal(caltable, sigma = 0, cycles = 3, stat = 'mean'):
+    """Read a caltable in a single pass, flag (if sigma > 0) and
+    compute what is needed for plots and QA
+    sigma, cycles, stat: see FlagCal()
+    Return a dict with:
+    'par': CPARAM (or FPARAM) - 'partype': 'CPARAM' or 'FPARAM'
+    'flag', 'ant', 'spw', 'time': FLAG, ANTENNA1, SPECTRAL_WINDOW_ID and TIME columns
+    (columns with varying shape are padded, see _getcolpad())
+    'antnames': antenna names from the ANTENNA subtable
+    'maxamp': maximum unflagged amplitude (0 if all flagged)
+    'flagfrac': flagged fraction of the solutions of each antenna (NaN if missing)
+    'flagsoln': flagged solutions per antenna/spw/pol, see getCalFlaggedSoln()
+    """
+    tb.open(caltable, nomodify=(sigma == 0))
     if 'CPARAM' in tb.colnames():
-        pars=tb.getcol('CPARAM')
+        partype = 'CPARAM'
     elif 'FPARAM' in tb.colnames():
-        pars=tb.getcol('FPARAM')
+        partype = 'FPARAM'
     else:
-        logging.error("Cannot flag "+caltable+". Unknown type.")
-        return
-    flags=tb.getcol('FLAG')
-    ants=tb.getcol('ANTENNA1')
-    totflag_before = sum(flags.flatten())
-    for c in xrange(cycles):
-        for ant in set(ants):
-            parant = pars[:,:, np.where( ants == ant ) ]
-            flagant = flags[:,:, np.where( ants == ant ) ]
-            good = np.logical_not(flagant)
-            if sum(good.flatten()) == 0: continue # all flagged antenna, continue
-            flagant[ np.abs( parant - np.mean(parant[good]) ) > sigma * np.std( parant[good] ) ] = True
-            flags[:,:, np.where( ants == ant ) ] = flagant
-    tb.putcol('FLAG', flags)
-    totflag_after = sum(flags.flatten())
-    logging.debug(caltable+": Flagged "+str(totflag_after-totflag_before)+" points out of "+str(len(flags.flatten()))+".")
+        logging.error("Cannot read "+caltable+". Unknown type.")
+        tb.close()
+        return None
+    varshape = tb.isvarcol(partype)
+    cal = {'partype':partype, 'par':_getcolpad(tb, partype, 0), \
+            'ant':tb.getcol('ANTENNA1'), 'spw':tb.getcol('SPECTRAL_WINDOW_ID'), 'time':tb.getcol('TIME')}
+    cal['flag'], nchan = _getcolpad(tb, 'FLAG', True, nchan=True)
+    if sigma > 0:
+        totflag_before = np.sum(cal['flag'])
+        cal['flag'] = _flagcal_arrays(cal['par'], cal['flag'], cal['ant'], sigma, cycles, stat)
+        totflag_after = np.sum(cal['flag'])
+        if totflag_after != totflag_before:
+            if varshape:
+                for row in xrange(tb.nrows()):
+                    shape = tb.getcolshapestring('FLAG', startrow=row, nrow=1)[0]
+                    nchan = int(shape.strip('[]').split(',')[1])
+                    tb.putcell('FLAG', row, cal['flag'][:,:nchan,row])
+            else: tb.putcol('FLAG', cal['flag'])
+        logging.debug(caltable+": Flagged "+str(totflag_after-totflag_before)+" points out of "+str(cal['flag'].size)+".")
+    tb.close()
+
+    tb.open(caltable+'/ANTENNA')
+    cal['antnames'] = tb.getcol('NAME')
     tb.close()
 
+    good = np.logical_not(cal['flag'])
+    if np.any(good): cal['maxamp'] = np.max(np.abs(cal['par'][good]))
+    else: cal['maxamp'] = 0.
+
+    # QA: flagged fraction per antenna, padded channels (flagged) are not solutions
+    nant = len(cal['antnames'])
+    pad = np.arange(cal['flag'].shape[1])[np.newaxis,:,np.newaxis] >= nchan[np.newaxis,np.newaxis,:]
+    nsol = np.bincount(cal['ant'], weights=nchan, minlength=nant) * cal['flag'].shape[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cal['flagfrac'] = np.bincount(cal['ant'], weights=np.sum(cal['flag'] & ~pad, axis=(0,1)), minlength=nant) / nsol
+    frac = np.sum(cal['flag'] & ~pad, axis=1) / nchan.astype(float)
+    cal['flagsoln'] = _flaggedSolnDict(frac, cal['ant'], cal['spw'])
+
+    return cal
+
+def _logCalQA(caltable, cal):
+    """Log the flagging QA of a caltable read with readCal()
+    """
+    if cal is None: return
+    log = caltable+': flagged solutions per antenna, '
+    for name, frac in zip(cal['antnames'], cal['flagfrac']):
+        if frac == frac: log += name +': %.2f%% - ' % (100.*frac)
+    logging.debug(log[:-3])
+    logging.info(caltable+': flagged solutions %.2f%% (median over antennas %.2f%%)' % \
+        (100.*cal['flagsoln']['all']['fraction'], 100.*cal['flagsoln']['antmedian']['fraction']))
+
+def FlagCal(caltable, sigma = 5, cycles = 3, stat = 'mean'):
+    """Flag sol outside n sigmas
+    Better high number of cycles (3) at high sigma (5)
+    stat: 'mean' (mean/std) or 'median' (median/MAD, robust to outliers)
+    Return the caltable content (see readCal()) to be reused for plotting
+    """
+    cal = readCal(caltable, sigma, cycles, stat)
+    _logCalQA(caltable, cal)
+    return cal
+
+def postCal(caltable, sigma = 0, cycles = 3, stat = 'mean', amp=False, phase=False, BL=False, delay=False):
+    """Flag (if sigma > 0) and plot a gain caltable reading it only once
+    sigma, cycles, stat: see FlagCal()
+    amp, phase, BL, delay: see plotGainCal()
+    """
+    cal = readCal(caltable, sigma, cycles, stat)
+    _logCalQA(caltable, cal)
+    if cal is not None: plotGainCal(caltable, amp=amp, phase=phase, BL=BL, delay=delay, cal=cal)
+    return cal
+
 def FlagBLcal(caltable, sigma = 5):
     """Flag BL which has a blcal outside n sigmas
     """
@@ -268,28 +1276,526 @@ def FlagBLcal(caltable, sigma = 5):
     tb.close()
 
 def getMaxAmp(caltable):
-    """Return maximum unflagged amp for plotting purposes
+    """Return maximum unflagged amp for plotting purposes (0 if unreadable)
     """
-    tb.open(caltable)
-    cpar=tb.getcol('CPARAM')
-    flgs=tb.getcol('FLAG')
-    tb.close()
-    amps=np.abs(cpar)
-    good=np.logical_not(flgs)
-    maxamp=np.max(amps[good])
-    return maxamp
+    cal = readCal(caltable)
+    if cal is None: return 0.
+    return cal['maxamp']
+
+def gainChange(caltable, oldcaltable):
+    """Compare two gain tables matching each solution with the nearest in time
+    of the same antenna/spw in the other table
+    Return median absolute phase change (deg) and amplitude change (fraction)
+    of the solutions unflagged in both
+    """
+    new, old = readCal(caltable), readCal(oldcaltable)
+    nspw = max(np.max(new['spw']), np.max(old['spw']))+1
+    # sort old solutions by antenna/spw then time and find the neighbours of each new one
+    tspan = max(np.max(new['time']), np.max(old['time'])) - min(np.min(new['time']), np.min(old['time'])) + 1.
+    keynew = (new['ant']*nspw + new['spw']) * 2*tspan + (new['time'] - np.min(old['time']))
+    keyold = (old['ant']*nspw + old['spw']) * 2*tspan + (old['time'] - np.min(old['time']))
+    order = np.argsort(keyold)
+    keyold = keyold[order]
+    idx = np.clip(np.searchsorted(keyold, keynew), 1, len(keyold)-1)
+    idx = np.where(np.abs(keyold[idx-1] - keynew) < np.abs(keyold[idx] - keynew), idx-1, idx)
+    match = order[idx]
+    same = (old['ant'][match] == new['ant']) & (old['spw'][match] == new['spw'])
+    good = np.logical_not(new['flag'] | old['flag'][:,:,match]) & same[np.newaxis,np.newaxis,:]
+    if not np.any(good): return np.nan, np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = new['par'][good] / old['par'][:,:,match][good]
+    return np.median(np.abs(np.angle(ratio, deg=True))), np.median(np.abs(np.abs(ratio) - 1.))
+
+class SelfcalMonitor(object):
+    """Follow the selfcal cycles of a source (rms, peak, dynamic range, change
+    of the gain solutions and time) and decide when they stop improving
+    cycles are in stages of the schedule, which can skip ahead (see skipPhase())
+    name: source name, for logging
+    tol: minimum fractional improvement of rms or dynamic range to go on
+    tolgain: minimum median phase change (deg) of the last solutions to go on
+    mincycles: never stop before this stage
+    ampcycle: first stage solving for amplitudes, never stop before its solutions are imaged
+    history: list of cycles of a previous run (to resume)
+    """
+    def __init__(self, name, tol=0.02, tolgain=1., mincycles=2, ampcycle=3, history=None):
+        self.name = name
+        self.tol = tol
+        self.tolgain = tolgain
+        if mincycles <= ampcycle:
+            logging.info('Selfcal '+self.name+': convergence checked from cycle '+str(ampcycle+1)+ \
+                ', after the first amplitude calibration (mincycles='+str(mincycles)+').')
+        self.mincycles = max(mincycles, ampcycle+1)
+        self.ampcycle = ampcycle
+        self.history = history if history is not None else []
+        self.stopped = False
+        self.t0 = None
+
+    def _close(self):
+        import time
+        if self.t0 is not None and self.history and not 'time' in self.history[-1]:
+            self.history[-1]['time'] = time.time() - self.t0
+
+    def start(self, cycle, stage=None):
+        """Start a cycle (at "stage" of the schedule, default: cycle), the previous one is closed
+        """
+        import time
+        self._close()
+        self.t0 = time.time()
+        self.history.append({'cycle':cycle, 'stage':cycle if stage is None else stage})
+
+    def image(self, img, rms):
+        """Record the image of this cycle
+        """
+        peak = float(imstat(imagename=img)['max'][0])
+        self.history[-1].update({'rms':float(rms), 'peak':peak, 'dr':peak/rms})
+        logging.info('Selfcal '+self.name+' cycle '+str(self.history[-1]['cycle'])+': rms=%.3g Jy/b, peak=%.3g Jy/b, DR=%.1f' % \
+            (rms, peak, peak/rms))
+
+    def gains(self, caltable, oldcaltable):
+        """Record the change of the solutions of this cycle with respect to the previous
+        """
+        phase, amp = gainChange(caltable, oldcaltable)
+        self.history[-1]['gainchange'] = float(phase)
+        logging.info('Selfcal '+self.name+' cycle '+str(self.history[-1]['cycle'])+': solutions changed by %.2f deg, %.2f%%' % \
+            (phase, 100.*amp))
+
+    def _stalled(self, action):
+        """True if the last image did not improve enough and the gains are stable
+        action: logged if stalled
+        """
+        prev, last = self.history[-2], self.history[-1]
+        drms = (prev['rms'] - last['rms']) / prev['rms']
+        ddr = (last['dr'] - prev['dr']) / prev['dr']
+        dgain = prev.get('gainchange', np.inf)
+        stalled = drms < self.tol and ddr < self.tol and not dgain > self.tolgain
+        logging.info('Selfcal '+self.name+': rms improved by %.1f%%, DR by %.1f%%, last solutions changed by %.2f deg -> %s' % \
+            (100.*drms, 100.*ddr, dgain, action if stalled else 'go on'))
+        return stalled
+
+    def converged(self):
+        """True if stalled (see _stalled()) from stage mincycles on
+        """
+        if len(self.history) < 2 or self.history[-1].get('stage', self.history[-1]['cycle']) < self.mincycles: return False
+        self.stopped = self._stalled('converged, stop')
+        return self.stopped
+
+    def skipPhase(self):
+        """True if the phase-only stages stalled (see _stalled()), the next calibration
+        should then be the one of stage ampcycle
+        """
+        if len(self.history) < 2 or self.history[-1].get('stage', self.history[-1]['cycle']) >= self.ampcycle: return False
+        return self._stalled('phase selfcal stalled, go on with the amplitude selfcal')
+
+    def summary(self, ncycles):
+        """Log the cost of each cycle and the estimated saving if stopped early
+        ncycles: number of cycles of the full schedule
+        """
+        self._close()
+        log = 'Selfcal '+self.name+' cycles:'
+        for h in self.history:
+            log += '\n cycle %i (stage %i): rms=%.3g DR=%.1f time=%.1f min' % (h['cycle'], h.get('stage', h['cycle']), \
+                h.get('rms', np.nan), h.get('dr', np.nan), h.get('time', 0)/60.)
+        skipped = ncycles - len(self.history)
+        if skipped > 0 and (self.stopped or self.history[-1].get('stage', self.history[-1]['cycle']) == ncycles-1):
+            meantime = np.mean([h.get('time', 0) for h in self.history])
+            log += '\n skipped %i cycles (~%.1f min)' % (skipped, skipped*meantime/60.)
+            if self.stopped:
+                # calibrations skipped: from the last stage (stopped before calibrating) to the one before the last
+                laststage = self.history[-1].get('stage', self.history[-1]['cycle'])
+                skippedamp = len([c for c in xrange(laststage, ncycles-1) if c >= self.ampcycle])
+                if skippedamp > 0: log += ', including %i amplitude selfcal cycles' % skippedamp
+        logging.info(log)
+
+def invertTable(caltab):
+    """Invert a calibration table
+    """
+    caltab = cloneMS(caltab, caltab+"_inv", writecols=['CPARAM'])
+    tb.open(caltab, nomodify=False) # open the caltable
+    gVals = tb.getcol('CPARAM')#, startrow=start, nrow=incr) # get the values from the GAIN column
+    mask = abs(gVals) > 0.0 # only consider non-zero values
+    gVals[mask] = 1.0 / gVals[mask] # do the inversion
+    tb.putcol('CPARAM', gVals)#, startrow=start, nrow=incr) # replace the GAIN values with the inverted values
+    tb.close() # close the table
+    return caltab
+
+# Stokes enum of casacore -> polarizations of the two antennas
+_corrPols = {5:(0,0), 6:(0,1), 7:(1,0), 8:(1,1), 9:(0,0), 10:(0,1), 11:(1,0), 12:(1,1)}
+
+def _readSolutions(caltable, spw, chanfreqs, nant, fmode, gainfield=[]):
+    """Read the solutions of a G, T, B or K table for "spw"
+    return (times, gains, flags, delay) with gains and flags shaped (time, ant, pol, chan)
+    and delay=reference frequency for K tables (gains are delays in ns), None if the table
+    cannot be applied by applyCal()
+    fmode: frequency interpolation, flagged channels are interpolated over unless it ends with 'flag'
+    """
+    tbLoc = casac.table()
+    tbLoc.open(caltable)
+    viscal = tbLoc.getkeyword('VisCal').split()[0]
+    if not viscal in ['G', 'T', 'B', 'K']:
+        tbLoc.close()
+        return None
+    query = 'SPECTRAL_WINDOW_ID=='+str(spw)
+    if gainfield != []: query += ' && FIELD_ID IN '+str(gainfield)
+    t = tbLoc.query(query)
+    if t.nrows() == 0:
+        t.close()
+        tbLoc.close()
+        return None
+    par = t.getcol('FPARAM' if viscal == 'K' else 'CPARAM')
+    flag = t.getcol('FLAG')
+    time, ant = t.getcol('TIME'), t.getcol('ANTENNA1')
+    t.close()
+    tbLoc.close()
+    tbLoc.open(caltable+'/SPECTRAL_WINDOW')
+    calfreqs = tbLoc.getcell('CHAN_FREQ', spw)
+    reffreq = tbLoc.getcell('REF_FREQUENCY', spw)
+    tbLoc.close()
 
-def plotGainCal(calt, amp=False, phase=False, BL=False, delay=False):
-    """Do the standard plot of gain solutions
+    npol, nchan = par.shape[0:2]
+    if nchan > 1 and (len(calfreqs) != len(chanfreqs) or not np.allclose(calfreqs, chanfreqs)): return None
+
+    times, tind = np.unique(time, return_inverse=True)
+    # e.g. different fields at the same time, which one applycal uses is not defined here
+    if len(np.unique(tind*nant+ant)) < len(ant): return None
+    # missing solutions are flagged
+    gains = np.ones((len(times), nant, npol, nchan), dtype=par.dtype)
+    flags = np.ones((len(times), nant, npol, nchan), dtype=bool)
+    gains[tind, ant] = par.transpose(2,0,1)
+    flags[tind, ant] = flag.transpose(2,0,1)
+
+    if nchan > 1 and not fmode.endswith('flag'):
+        g, f = gains.reshape(-1, nchan), flags.reshape(-1, nchan)
+        x = np.arange(nchan)
+        for r in np.where(f.any(axis=1) & ~f.all(axis=1))[0]:
+            good = np.where(~f[r])[0]
+            if fmode == 'nearest':
+                g[r] = g[r][good[np.abs(x[:,np.newaxis]-good[np.newaxis,:]).argmin(axis=1)]]
+            else:
+                amp = np.interp(x, good, np.abs(g[r][good]))
+                ph = np.interp(x, good, np.unwrap(np.angle(g[r][good])))
+                g[r] = amp*np.exp(1j*ph)
+            f[r] = False
+
+    return times, gains, flags, (reffreq if viscal == 'K' else None)
+
+def _interpTime(times, gains, flags, t, tmode):
+    """Interpolate (time, ...) solutions at times "t" ('linear' in amp and phase or 'nearest')
+    using for each element only its unflagged solutions, return (len(t), ...) gains and flags
+    """
+    nt = len(times)
+    shape = gains.shape[1:]
+    g, f = gains.reshape(nt, -1), flags.reshape(nt, -1)
+    idx = np.arange(nt)[:,np.newaxis] * np.ones(g.shape[1], dtype=int)
+    # previous and next unflagged solution of each element
+    prev = np.maximum.accumulate(np.where(f, -1, idx), axis=0)
+    nxt = np.minimum.accumulate(np.where(f, nt, idx)[::-1], axis=0)[::-1]
+    k = np.searchsorted(times, t, side='right') - 1
+    p = np.where((k >= 0)[:,np.newaxis], prev[np.clip(k, 0, nt-1)], -1)
+    n = np.where((k+1 < nt)[:,np.newaxis], nxt[np.clip(k+1, 0, nt-1)], nt)
+    hasp, hasn = p >= 0, n < nt
+    p, n = np.clip(p, 0, nt-1), np.clip(n, 0, nt-1)
+    cols = np.arange(g.shape[1])
+    gp, gn, tp, tn = g[p, cols], g[n, cols], times[p], times[n]
+    t = t[:,np.newaxis]
+    if tmode == 'nearest':
+        out = np.where(hasn & (~hasp | (tn - t < t - tp)), gn, gp)
+    else:
+        # outside the solutions the nearest is used
+        w = np.where(hasp & hasn, (t - tp) / np.where(tn > tp, tn - tp, 1.), 0.)
+        w = np.where(hasp, w, 1.)
+        if np.iscomplexobj(g):
+            out = ((1-w)*np.abs(gp) + w*np.abs(gn)) * np.exp(1j*(np.angle(gp) + w*np.angle(gn*np.conj(gp))))
+        else: out = (1-w)*gp + w*gn
+    flag = ~(hasp | hasn)
+    out = np.where(flag, 1, out)
+    return out.reshape((len(t),)+shape), flag.reshape((len(t),)+shape)
+
+def _applyCalNative(vis, gaintable, interp, field, scan, gainfield, inverse, memlimit=1024):
+    """Write CORRECTED_DATA = DATA corrected for the gaintables (as applycal with calwt=False)
+    interpolating and applying the solutions in numpy on chunks of rows
+    Diagonal G, T, B and K tables with 'linear'/'nearest' time interpolation are supported
+    (freq interpolation ending with 'flag' flags the channels with flagged solutions)
+    return False (and do nothing) for anything else
+    """
+    modes = [(i.split(',')+['linear'])[0:2] for i in interp]
+    modes = [(tmode or 'linear', fmode or 'linear') for tmode, fmode in modes]
+    fields, scans, gainfields = _parseIds(field), _parseIds(scan), [_parseIds(g) for g in gainfield]
+
+    if fields is None or scans is None or None in gainfields or \
+            not all([tmode in ['linear', 'nearest'] and fmode in ['linear', 'nearest', 'linearflag', 'nearestflag'] \
+            for tmode, fmode in modes]):
+        return False
+
+    tbLoc = casac.table()
+    tbLoc.open(vis+'/ANTENNA')
+    nant = tbLoc.nrows()
+    tbLoc.close()
+    tbLoc.open(vis+'/SPECTRAL_WINDOW')
+    chanfreqs = [tbLoc.getcell('CHAN_FREQ', i) for i in xrange(tbLoc.nrows())]
+    tbLoc.close()
+    tbLoc.open(vis+'/POLARIZATION')
+    corrtypes = [tbLoc.getcell('CORR_TYPE', i) for i in xrange(tbLoc.nrows())]
+    tbLoc.close()
+    tbLoc.open(vis+'/DATA_DESCRIPTION')
+    ddspw = tbLoc.getcol('SPECTRAL_WINDOW_ID')
+    ddpol = tbLoc.getcol('POLARIZATION_ID')
+    tbLoc.close()
+
+    query = 'DATA_DESC_ID >= 0'
+    if fields != []: query += ' && FIELD_ID IN '+str(fields)
+    if scans != []: query += ' && SCAN_NUMBER IN '+str(scans)
+    tbLoc.open(vis)
+    t = tbLoc.query(query, columns='DATA_DESC_ID')
+    ddids = np.unique(t.getcol('DATA_DESC_ID')) if t.nrows() > 0 else []
+    t.close()
+    tbLoc.close()
+
+    # read everything before touching the data, so that applycal can still be used
+    sols = {}
+    for ddid in ddids:
+        spw = ddspw[ddid]
+        if not all([c in _corrPols for c in corrtypes[ddpol[ddid]]]): return False
+        for i, caltable in enumerate(gaintable):
+            if (i, spw) in sols: continue
+            sols[(i, spw)] = _readSolutions(caltable, spw, chanfreqs[spw], nant, modes[i][1], gainfields[i])
+            if sols[(i, spw)] is None: return False
+
+    logging.debug("Applying "+str(gaintable)+(" (inverse)" if inverse else "")+" to "+vis)
+    tbLoc.open(vis)
+    addcorr = not 'CORRECTED_DATA' in tbLoc.colnames()
+    tbLoc.close()
+    if addcorr:
+        default('clearcal')
+        clearcal(vis=vis)
+
+    tbLoc.open(vis, nomodify=False)
+    for ddid in ddids:
+        spw = ddspw[ddid]
+        pols = [_corrPols[c] for c in corrtypes[ddpol[ddid]]]
+        t = tbLoc.query(query+' && DATA_DESC_ID=='+str(ddid))
+        nrows = t.nrows()
+        chunk = max(1, int(memlimit*1024**2/(48*len(pols)*len(chanfreqs[spw]))))
+        for row in xrange(0, nrows, chunk):
+            time, ant1, ant2 = [t.getcol(c, startrow=row, nrow=chunk) for c in ['TIME', 'ANTENNA1', 'ANTENNA2']]
+            data = t.getcol('DATA', startrow=row, nrow=chunk)
+            flag = t.getcol('FLAG', startrow=row, nrow=chunk)
+            utime, tidx = np.unique(time, return_inverse=True)
+            corr = np.ones(data.shape, dtype=np.complex128)
+            for i in xrange(len(gaintable)):
+                times, gains, flags, reffreq = sols[(i, spw)]
+                g, f = _interpTime(times, gains, flags, utime, modes[i][0])
+                if reffreq is not None:
+                    g = np.exp(2j*np.pi*1e-9*g*(chanfreqs[spw]-reffreq))
+                npol = g.shape[2]
+                for c, (p, q) in enumerate(pols):
+                    p, q = min(p, npol-1), min(q, npol-1)
+                    corr[c] *= (g[tidx, ant1, p] * np.conj(g[tidx, ant2, q])).T
+                    flag[c] |= (f[tidx, ant1, p] | f[tidx, ant2, q]).T
+            # zero gains cannot be inverted
+            flag |= (corr == 0)
+            corr[corr == 0] = 1
+            if inverse: data *= corr
+            else: data /= corr
+            t.putcol('CORRECTED_DATA', data, startrow=row, nrow=chunk)
+            t.putcol('FLAG', flag, startrow=row, nrow=chunk)
+        t.close()
+    tbLoc.close()
+    return True
+
+def _applyCalCasa(vis, gaintable, interp, field, scan, gainfield, inverse):
+    """applycal (calwt=False), through inverted copies of the tables if inverse
+    (removed afterwards)
+    """
+    tables = [invertTable(t) for t in gaintable] if inverse else gaintable
+    default('applycal')
+    applycal(vis=vis, field=field, scan=scan, gaintable=tables, gainfield=gainfield, interp=interp, \
+        calwt=False, flagbackup=False)
+    if inverse: check_rm(tables)
+
+def checkApplyCal(vis, gaintable, interp=[], field='', scan='', gainfield=[], inverse=False, rtol=1e-4):
+    """Compare CORRECTED_DATA and FLAG written by applycal and by the numpy engine of applyCal()
+    on the first selected scan of "vis" (two copies of the rows of that scan are used, "vis" is untouched)
+    rtol: tolerance on the corrected visibilities (relative to their median amplitude)
+    return True if they match, False if not or if the tables are not supported natively
     """
+    if type(gaintable) is str: gaintable = [gaintable]
+    interp = list(interp) + ['linear']*(len(gaintable)-len(interp))
+    gainfield = list(gainfield) + ['']*(len(gaintable)-len(gainfield))
+    query = 'DATA_DESC_ID >= 0'
+    if _parseIds(field): query += ' && FIELD_ID IN '+str(_parseIds(field))
+    if _parseIds(scan): query += ' && SCAN_NUMBER IN '+str(_parseIds(scan))
     tbLoc = casac.table()
-    tbLoc.open( '%s/ANTENNA' % calt)
-    nameAntenna = tbLoc.getcol( 'NAME' )
-    numAntenna = len(nameAntenna)
+    tbLoc.open(vis)
+    t = tbLoc.query(query, columns='SCAN_NUMBER')
+    scan0 = str(t.getcell('SCAN_NUMBER', 0)) if t.nrows() > 0 else ''
+    t.close()
     tbLoc.close()
+    if scan0 == '': return False
+
+    # deep copies of the selected rows keep the subtables and all the ids of "vis"
+    query += ' && SCAN_NUMBER=='+scan0
+    viscasa, visnative = vis.rstrip('/')+'_chk-casa', vis.rstrip('/')+'_chk-native'
+    check_rm([viscasa, visnative])
+    tbLoc.open(vis)
+    for outvis in [viscasa, visnative]:
+        t = tbLoc.query(query)
+        t.copy(newtablename=outvis, deep=True, valuecopy=True).close()
+        t.close()
+    tbLoc.close()
+    _applyCalCasa(viscasa, gaintable, interp, field, scan0, gainfield, inverse)
+    match = _applyCalNative(visnative, gaintable, interp, field, scan0, gainfield, inverse)
+
+    tbcasa, tbnative = casac.table(), casac.table()
+    tbcasa.open(viscasa)
+    tbnative.open(visnative)
+    t = tbcasa.query(query, columns='DATA_DESC_ID')
+    ddids = np.unique(t.getcol('DATA_DESC_ID'))
+    t.close()
+    for ddid in ddids:
+        if not match: break
+        tc, tn = tbcasa.query(query+' && DATA_DESC_ID=='+str(ddid)), tbnative.query(query+' && DATA_DESC_ID=='+str(ddid))
+        fc, fn = tc.getcol('FLAG'), tn.getcol('FLAG')
+        dc, dn = tc.getcol('CORRECTED_DATA'), tn.getcol('CORRECTED_DATA')
+        tc.close()
+        tn.close()
+        good = ~fc & ~fn
+        scale = np.median(np.abs(dc[good])) if good.any() else 1.
+        maxdiff = np.max(np.abs(dc[good]-dn[good])) / scale if good.any() else 0.
+        logging.debug("checkApplyCal ddid "+str(ddid)+": "+str(np.sum(fc != fn))+" flags differ, max relative difference "+str(maxdiff))
+        match = np.array_equal(fc, fn) and maxdiff <= rtol
+    tbcasa.close()
+    tbnative.close()
+    check_rm([viscasa, visnative])
+    if not match: logging.warning("Native calibration of "+str(gaintable)+" does not match applycal.")
+    return match
+
+# results of checkApplyCal(): {(table types, interp, gainfield used, inverse): match}
+_applyCalChecked = {}
+
+def applyCal(vis, gaintable, interp=[], field='', scan='', gainfield=[], inverse=False, native=False, memlimit=1024):
+    """Write CORRECTED_DATA = DATA corrected for the gaintables, as applycal with calwt=False
+    interp, field, scan, gainfield: as in applycal
+    inverse: apply the inverse correction, i.e. corrupt the data with the gains
+    native: interpolate and apply in numpy (see _applyCalNative()) if the tables are supported,
+    each combination of table types and interpolations is first verified against applycal
+    with checkApplyCal(), applycal is used if they do not match
+    memlimit: max memory (MB) used for the data read at once by the numpy engine
+    """
+    if type(gaintable) is str: gaintable = [gaintable]
+    interp = list(interp) + ['linear']*(len(gaintable)-len(interp))
+    gainfield = list(gainfield) + ['']*(len(gaintable)-len(gainfield))
+
+    if native:
+        tbLoc = casac.table()
+        types = []
+        for caltable in gaintable:
+            tbLoc.open(caltable)
+            types.append(tbLoc.getkeyword('VisCal'))
+            tbLoc.close()
+        key = (tuple(types), tuple(interp), tuple([g != '' for g in gainfield]), inverse)
+        if not key in _applyCalChecked:
+            _applyCalChecked[key] = checkApplyCal(vis, gaintable, interp, field, scan, gainfield, inverse)
+        if _applyCalChecked[key] and _applyCalNative(vis, gaintable, interp, field, scan, gainfield, inverse, memlimit):
+            return
+
+    _applyCalCasa(vis, gaintable, interp, field, scan, gainfield, inverse)
+
+def _calHash(cal, *extra):
+    """Content hash of a caltable read with readCal() plus any extra parameter
+    """
+    import hashlib
+    h = hashlib.md5()
+    for k in ['par','flag','ant','spw','time']:
+        h.update(np.ascontiguousarray(cal[k]).tostring())
+    h.update(repr(extra))
+    return h.hexdigest()
+
+def _plotCalNative(calt, cal, prefix, yaxis, xaxis='time', plotrange=[], plotsymbol='o-', plotcolor='blue', freqs=None):
+    """Plot solutions with matplotlib (Agg) in the same layout of plotcal
+    (3 antennas per file, one panel each) using the arrays of readCal()
+    prefix: files are calt.replace('cal/','plots/')+prefix+N+'.png'
+    yaxis: 'amp', 'phase' or 'delay'
+    xaxis: 'time' or 'freq' (then freqs must contain the CHAN_FREQ of each spw)
+    plotrange: [xmin,xmax,ymin,ymax] as in plotcal, 0,0 is automatic
+    Plots are not re-rendered if the caltable content did not change.
+    Return False if matplotlib is not available
+    """
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        logging.warning("Cannot import matplotlib, using plotcal.")
+        return False
+
+    filebase = calt.replace('cal/','plots/')+prefix
+    nplots = int(len(cal['antnames'])/3)
+    filenames = [filebase+str(ii)+'.png' for ii in range(nplots)]
+    calhash = _calHash(cal, yaxis, xaxis, plotrange, plotsymbol, plotcolor)
+    if os.path.exists(filebase+'.md5') and open(filebase+'.md5').read() == calhash \
+            and all([os.path.exists(filename) for filename in filenames]):
+        logging.debug("Plots "+filebase+"* are up to date.")
+        return True
+
+    par = cal['par']
+    if yaxis == 'amp': y = np.abs(par)
+    elif yaxis == 'phase': y = np.angle(par, deg=True)
+    else: y = np.real(par)
+    # flagged solutions are not plotted (lines are broken at NaNs)
+    y = np.where(cal['flag'], np.nan, y)
+    if xaxis == 'freq':
+        x = np.array([freqs[spw] for spw in cal['spw']]).T/1.e6 # (chan, row) in MHz
+        xlabel = 'Frequency (MHz)'
+    else:
+        x = np.repeat(((cal['time'] % 86400.)/3600.)[np.newaxis,:], par.shape[1], axis=0) # (chan, row) in h
+        xlabel = 'Time (h)'
+    ylabel = {'amp':'Amp', 'phase':'Phase (deg)', 'delay':'Delay (ns)'}[yaxis]
+
+    for ii, filename in enumerate(filenames):
+        fig = Figure(figsize=(8,10))
+        FigureCanvasAgg(fig)
+        fig.subplots_adjust(hspace=0.3)
+        for j in xrange(3):
+            ant = ii*3+j
+            ax = fig.add_subplot(3,1,j+1)
+            rows = np.flatnonzero(cal['ant'] == ant)
+            rows = rows[np.argsort(cal['time'][rows], kind='mergesort')]
+            for pol in xrange(par.shape[0]):
+                if xaxis == 'freq': # one line per solution along freq
+                    ax.plot(x[:,rows], y[pol][:,rows], plotsymbol, color=plotcolor, markersize=5.0)
+                else: # one line per channel along time
+                    ax.plot(x[:,rows].T, y[pol][:,rows].T, plotsymbol, color=plotcolor, markersize=5.0)
+            if len(plotrange) == 4:
+                if plotrange[0] != plotrange[1]: ax.set_xlim(plotrange[0], plotrange[1])
+                if plotrange[2] != plotrange[3]: ax.set_ylim(plotrange[2], plotrange[3])
+            ax.set_title('Antenna '+cal['antnames'][ant], fontsize=10)
+            ax.set_ylabel(ylabel, fontsize=10)
+        ax.set_xlabel(xlabel, fontsize=10)
+        fig.savefig(filename)
+
+    with open(filebase+'.md5', 'w') as f:
+        f.write(calhash)
+    return True
+
+def plotGainCal(calt, amp=False, phase=False, BL=False, delay=False, cal=None, native=True):
+    """Do the standard plot of gain solutions
+    cal: caltable content already read with readCal(), if None it is read here
+    native: plot with matplotlib instead of plotcal (not for BL tables)
+    """
+    if cal is None: cal = readCal(calt)
+    if native and not BL:
+        done = True
+        if amp == True:
+            done &= _plotCalNative(calt, cal, 'a_', 'amp', plotrange=[0,0,0,cal['maxamp']], plotcolor='red')
+        if phase == True:
+            done &= _plotCalNative(calt, cal, 'p_', 'phase', plotrange=[0,0,-180,180], plotcolor='blue')
+        if delay == True:
+            done &= _plotCalNative(calt, cal, '_', 'delay', plotrange=[])
+        if done: return
+
+    numAntenna = len(cal['antnames'])
     nplots=int(numAntenna/3)
     if amp == True:
-        plotmax = getMaxAmp(calt)
+        plotmax = cal['maxamp']
         for ii in range(nplots):
             filename=calt.replace('cal/','plots/')+'a_'+str(ii)+'.png'
             syscommand='rm -rf '+filename
@@ -329,41 +1835,35 @@ def plotGainCal(calt, amp=False, phase=False, BL=False, delay=False):
                 figfile=filename)
 
 
-def plotBPCal(calt, amp=False, phase=False):
+def plotBPCal(calt, amp=False, phase=False, native=True):
     """Do the standard plot of bandpass solutions
+    native: plot with matplotlib instead of plotcal
     """
-    tb.open(calt)
-    dataVarCol = tb.getvarcol('CPARAM')
-    flagVarCol = tb.getvarcol('FLAG')
-    tb.close()
-    rowlist = dataVarCol.keys()
-    nrows = len(rowlist)
-    maxmaxamp = 0.0
-    maxmaxphase = 0.0
-    for rrow in rowlist:
-        dataArr = dataVarCol[rrow]
-        flagArr = flagVarCol[rrow]
-        amps=np.abs(dataArr)
-        phases=np.arctan2(np.imag(dataArr),np.real(dataArr))
-        good=np.logical_not(flagArr)
-        tmparr=amps[good]
-        if (len(tmparr)>0):
-            maxamp=np.max(amps[good])
-            if (maxamp>maxmaxamp):
-                maxmaxamp=maxamp
-        tmparr=np.abs(phases[good])
-        if (len(tmparr)>0):
-            maxphase=np.max(np.abs(phases[good]))*180./pi
-            if (maxphase>maxmaxphase):
-                maxmaxphase=maxphase
-    ampplotmax=maxmaxamp
-    phaseplotmax=maxmaxphase
-
-    tbLoc = casac.table()
-    tbLoc.open( '%s/ANTENNA' % calt)
-    nameAntenna = tbLoc.getcol( 'NAME' )
-    numAntenna = len(nameAntenna)
-    tbLoc.close()
+    cal = readCal(calt)
+    good = np.logical_not(cal['flag'])
+    ampplotmax = cal['maxamp']
+    if np.any(good): phaseplotmax = np.max(np.abs(np.angle(cal['par'][good])))*180./np.pi
+    else: phaseplotmax = 0.
+
+    if native:
+        # channel frequencies of each spw, NaN-padded as the solutions
+        tb.open(calt+'/SPECTRAL_WINDOW')
+        freqs = np.empty((tb.nrows(), cal['par'].shape[1]))
+        freqs[:] = np.nan
+        for spw in xrange(tb.nrows()):
+            chanfreq = tb.getcell('CHAN_FREQ', spw)
+            freqs[spw,:len(chanfreq)] = chanfreq
+        tb.close()
+        done = True
+        if amp == True:
+            done &= _plotCalNative(calt, cal, 'a_', 'amp', xaxis='freq', plotrange=[0,0,0,ampplotmax], \
+                plotsymbol='o', plotcolor='blue', freqs=freqs)
+        if phase == True:
+            done &= _plotCalNative(calt, cal, 'p_', 'phase', xaxis='freq', plotrange=[0,0,-phaseplotmax,phaseplotmax], \
+                plotsymbol='o', plotcolor='blue', freqs=freqs)
+        if done: return
+
+    numAntenna = len(cal['antnames'])
     nplots=int(numAntenna/3)
 
     if amp == True:
@@ -389,11 +1889,88 @@ def plotBPCal(calt, amp=False, phase=False):
                 plotsymbol='o',plotcolor='blue',markersize=5.0,fontsize=10.0,showgui=False,figfile=filename)
 
 
-def correctPB(imgname, freq=0, phaseCentre=None):
+def _pbBlock(shape, rows, centre, scale2, parm):
+    """Return the GMRT primary beam (float32) for the pixel block x=0..shape[0]-1, y=rows
+    centre: phase centre pixel
+    scale2: (pix -> arcmin*GHz)^2
+    parm: polynomial coefficients already scaled by 10^3, 10^7, 10^10, 10^13
+    """
+    dx2 = (np.arange(shape[0], dtype=np.float32) - np.float32(centre[0]))**2
+    dy2 = (np.asarray(rows, dtype=np.float32) - np.float32(centre[1]))**2
+    r2 = (dx2[:,np.newaxis] + dy2[np.newaxis,:]) * np.float32(scale2)
+    a, b, c, e = [np.float32(p) for p in parm]
+    # Horner in r^2: 1 + a r^2 + b r^4 + c r^6 + e r^8
+    beam = r2 * e
+    beam += c
+    beam *= r2
+    beam += b
+    beam *= r2
+    beam += a
+    beam *= r2
+    beam += 1
+    return beam
+
+def _cacheEvict(cachedir, maxsize, keep=None):
+    """Remove the least recently used files in "cachedir" until
+    their total size is below "maxsize" MB
+    keep: file never removed (e.g. the one about to be used)
+    the cache may be shared by concurrent processes: vanished files are ignored
+    """
+    files = []
+    for f in os.listdir(cachedir):
+        f = os.path.join(cachedir, f)
+        if os.path.basename(f).startswith('.') or f == keep: continue
+        try: files.append((os.path.getmtime(f), os.path.getsize(f), f))
+        except OSError: continue
+    files.sort()
+    totsize = sum([f[1] for f in files])
+    if keep is not None and os.path.exists(keep): totsize += os.path.getsize(keep)
+    while files and totsize > maxsize*1024**2:
+        mtime, size, f = files.pop(0)
+        logging.debug("Evicting "+f+" from cache")
+        try: os.remove(f)
+        except OSError: pass
+        totsize -= size
+
+def _pbCache(cachedir, cachesize, shape, increment, freq, centre, scale2, parm, nrows):
+    """Return the (y, x) float32 beam from the on-disk cache as a memmap,
+    computing and storing it if not present
+    """
+    import hashlib
+    key = hashlib.md5(repr((tuple(shape[0:2]), [float(i) for i in increment[0:2]], freq, \
+        [round(float(c), 3) for c in centre]))).hexdigest()
+    beamfile = os.path.join(cachedir, 'pb-'+key+'.npy')
+    if os.path.exists(beamfile):
+        # may be evicted meanwhile by a concurrent process
+        try:
+            os.utime(beamfile, None) # LRU
+            beam = np.load(beamfile, mmap_mode='r')
+            logging.debug("Primary beam from cache: "+beamfile)
+            return beam
+        except (OSError, IOError): pass
+
+    if not os.path.exists(cachedir): os.makedirs(cachedir)
+    # write to a hidden file then rename, so partial beams are never reused
+    tmpfile = os.path.join(cachedir, '.pb-'+key+'-'+str(os.getpid())+'.npy')
+    beam = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.float32, shape=(shape[1], shape[0]))
+    for y0 in xrange(0, shape[1], nrows):
+        y1 = min(y0+nrows, shape[1])
+        beam[y0:y1] = _pbBlock(shape, np.arange(y0, y1), centre, scale2, parm).T
+    del beam
+    os.rename(tmpfile, beamfile)
+    # the open memmap survives the removal of the file
+    beam = np.load(beamfile, mmap_mode='r')
+    _cacheEvict(cachedir, cachesize, keep=beamfile)
+    return beam
+
+def correctPB(imgname, freq=0, phaseCentre=None, blockmem=64, cachedir='', cachesize=2000):
     """Given an image "img" create the "img.pbcorr" which
     has each pixel corrected for the GMRT primary beam effect.
     freq: force the observing frequency
     phaseCentre: [ra,dec] in deg of the pointing direction
+    blockmem: MB of image data processed at once (the beam is computed per block of rows)
+    cachedir: if set, beams are cached there and reused for images with the same geometry
+    cachesize: max size (MB) of the beam cache, least recently used beams are removed
     """
     import numpy as np
     img = ia.open(imgname)
@@ -410,6 +1987,7 @@ def correctPB(imgname, freq=0, phaseCentre=None):
     325: [-3.397,47.192,-30.931,7.803],
     610: [-3.486,47.749,-35.203,10.399],
     1400: [-2.27961,21.4611,-9.7929,1.80153]}[freq]
+    parm = [parm[0]/1.e3, parm[1]/1.e7, parm[2]/1.e10, parm[3]/1.e13]
 
     # if not specified assuming pointing in the centre of the image
     if phaseCentre == None:
@@ -418,21 +1996,28 @@ def correctPB(imgname, freq=0, phaseCentre=None):
         pixPhaseCentre = ia.topixel( qa.quantity(str(phaseCentre[0])+'deg'), qa.quantity(str(phaseCentre[1])+'deg') )['numeric'][0:2]
         logging.warning("Phase centre is at pix: "+str(pixPhaseCentre))
 
-    # function to initialize the beam-array
     assert abs(cs.increment()['numeric'][0]) == abs(cs.increment()['numeric'][1])
     pix2deg = abs(cs.increment()['numeric'][0])*180./np.pi # increment is in rad
-    def beam_creator(i,j):
-        # get distance from phase centre pixel in deg
-        d = np.sqrt( (pixPhaseCentre[0] - i)**2 + (pixPhaseCentre[1] - j)**2 ) * pix2deg
-        # from http://www.aips.nrao.edu/cgi-bin/ZXHLP2.PL?PBCOR (converto to arcmin and multiply by freq in GHz)
-        d = d * 60 * freq/1.e3
-        return 1 + (parm[0]/10**3)*d**2 + (parm[1]/10**7)*d**4 + \
-             (parm[2]/10**10)*d**6 + (parm[3]/10**13)*d**8
-
-    beam = np.fromfunction(beam_creator, ia.shape()[0:2])
-
-    # write new image
-    impbcor(imagename=imgname, pbimage=beam, outfile=imgname+'.pbcorr', mode='divide', overwrite=True)
+    # from http://www.aips.nrao.edu/cgi-bin/ZXHLP2.PL?PBCOR (distance in arcmin multiplied by freq in GHz)
+    scale2 = (pix2deg * 60 * freq/1.e3)**2
+    shape = ia.shape()
+    ia.close()
+
+    # copy the image (with mask) and divide it in place block by block
+    ia.fromimage(outfile=imgname+'.pbcorr', infile=imgname, overwrite=True)
+    nrows = max(1, int(blockmem*1024**2 / (8*np.prod(shape)/shape[1])))
+    if cachedir != '':
+        beamcache = _pbCache(cachedir, cachesize, shape, cs.increment()['numeric'], freq, pixPhaseCentre, scale2, parm, nrows)
+    for y0 in xrange(0, shape[1], nrows):
+        y1 = min(y0+nrows, shape[1])
+        if cachedir != '': beam = np.array(beamcache[y0:y1].T)
+        else: beam = _pbBlock(shape, np.arange(y0, y1), pixPhaseCentre, scale2, parm)
+        blc = [0, y0] + [0]*(len(shape)-2)
+        trc = [shape[0]-1, y1-1] + [n-1 for n in shape[2:]]
+        data = ia.getchunk(blc=blc, trc=trc)
+        data /= beam.reshape(beam.shape + (1,)*(len(shape)-2))
+        ia.putchunk(data, blc=blc)
+    ia.close()
 
 
 # From the EVLA pipeline
@@ -536,143 +2121,65 @@ def getCalFlaggedSoln(calTable):
     #mytb = tbtool.create()
     mytb = casac.table()
 
-    import pylab as pl
-    
     mytb.open(calTable)
     antCol = mytb.getcol('ANTENNA1')
     spwCol = mytb.getcol('SPECTRAL_WINDOW_ID')
-    fldCol = mytb.getcol('FIELD_ID')
-    #flagCol = mytb.getcol('FLAG')
-    flagVarCol = mytb.getvarcol('FLAG')
+    if mytb.isvarcol('FLAG'):
+        flagVarCol = mytb.getvarcol('FLAG')
+        frac = np.array([np.mean(flagVarCol['r'+str(i+1)][:,:,0], axis=1) for i in xrange(len(flagVarCol))]).T
+    else:
+        frac = np.mean(mytb.getcol('FLAG'), axis=1)
     mytb.close()
 
-    # Initialize a list to hold the results
-    # Get shape of FLAG
-    #(np,nc,ni) = flagCol.shape
-    rowlist = flagVarCol.keys()
-    nrows = len(rowlist)
-
-    # Create the output dictionary
-    outDict = {}
-    outDict['all'] = {}
-    outDict['antspw'] = {}
-    outDict['ant'] = {}
-    outDict['spw'] = {}
-    outDict['antmedian'] = {}
-
-    # Ok now go through and for each row and possibly channel compile flags
-    ntotal = 0
-    nflagged = 0
-    # Lists for median calc
-    medDict = {}
-    medDict['total'] = []
-    medDict['flagged'] = []
-    medDict['fraction'] = []
-    
-    for rrow in rowlist:
-        rown = rrow.strip('r')
-        idx = int(rown)-1
-        antIdx = antCol[idx]
-        spwIdx = spwCol[idx]
-        #
-        flagArr = flagVarCol[rrow]
-        # Get the shape of this data row
-        (np,nc,ni) = flagArr.shape
-        # ni should be 1 for this
-        iid = 0
-        #
-        # Set up dictionaries if needed
-        if outDict['antspw'].has_key(antIdx):
-            if not outDict['antspw'][antIdx].has_key(spwIdx):
-                outDict['antspw'][antIdx][spwIdx] = {}
-                for poln in range(np):
-                    outDict['antspw'][antIdx][spwIdx][poln] = {}
-                    outDict['antspw'][antIdx][spwIdx][poln]['total'] = 0
-                    outDict['antspw'][antIdx][spwIdx][poln]['flagged'] = 0
-        else:
-            outDict['ant'][antIdx] = {}
-            outDict['antspw'][antIdx] = {}
-            outDict['antspw'][antIdx][spwIdx] = {}
-            for poln in range(np):
-                outDict['ant'][antIdx][poln] = {}
-                outDict['ant'][antIdx][poln]['total'] = 0
-                outDict['ant'][antIdx][poln]['flagged'] = 0.0
-                outDict['antspw'][antIdx][spwIdx][poln] = {}
-                outDict['antspw'][antIdx][spwIdx][poln]['total'] = 0
-                outDict['antspw'][antIdx][spwIdx][poln]['flagged'] = 0.0
-        if not outDict['spw'].has_key(spwIdx):
-            outDict['spw'][spwIdx] = {}
-            for poln in range(np):
-                outDict['spw'][spwIdx][poln] = {}
-                outDict['spw'][spwIdx][poln]['total'] = 0
-                outDict['spw'][spwIdx][poln]['flagged'] = 0.0
-        #
-        # Sum up the in-row (per pol per chan) flags for this row
-        nptotal = 0
-        npflagged = 0
-        for poln in range(np):
-            ntotal += 1
-            nptotal += 1
-            ncflagged = 0
-            for chan in range(nc):
-                if flagArr[poln][chan][iid]:
-                    ncflagged += 1
-            npflagged = float(ncflagged)/float(nc)
-            nflagged += float(ncflagged)/float(nc)
-            #
-            outDict['ant'][antIdx][poln]['total'] += 1
-            outDict['spw'][spwIdx][poln]['total'] += 1
-            outDict['antspw'][antIdx][spwIdx][poln]['total'] += 1
-            #
-            outDict['ant'][antIdx][poln]['flagged'] += npflagged
-            outDict['spw'][spwIdx][poln]['flagged'] += npflagged
-            outDict['antspw'][antIdx][spwIdx][poln]['flagged'] += npflagged
-            #
-
-    outDict['all']['total'] = ntotal
-    outDict['all']['flagged'] = nflagged
-    if ntotal>0:
-        outDict['all']['fraction'] = float(nflagged)/float(ntotal)
+    return _flaggedSolnDict(frac, antCol, spwCol)
+
+
+def _flaggedSolnDict(frac, ant, spw):
+    """Build the getCalFlaggedSoln() dictionary with grouped sums
+    frac: (pol, row) fraction of flagged channels
+    ant, spw: (row) antenna and spw of each row
+    """
+    npol, nrows = frac.shape
+    outDict = {'all':{}, 'antspw':{}, 'ant':{}, 'spw':{}, 'antmedian':{}}
+
+    outDict['all']['total'] = npol*nrows
+    outDict['all']['flagged'] = float(frac.sum()) if nrows > 0 else 0
+    if nrows > 0:
+        outDict['all']['fraction'] = outDict['all']['flagged']/float(npol*nrows)
     else:
         outDict['all']['fraction'] = 0.0
 
-    # Go back and get fractions
-    for antIdx in outDict['ant'].keys():
-        nptotal = 0
-        npflagged = 0
-        for poln in outDict['ant'][antIdx].keys():
-            nctotal = outDict['ant'][antIdx][poln]['total']
-            ncflagged = outDict['ant'][antIdx][poln]['flagged']
-            outDict['ant'][antIdx][poln]['fraction'] = float(ncflagged)/float(nctotal)
-            #
-            nptotal += nctotal
-            npflagged += ncflagged
-        medDict['total'].append(nptotal)
-        medDict['flagged'].append(npflagged)
-        medDict['fraction'].append(float(npflagged)/float(nptotal))
-    #
-    for spwIdx in outDict['spw'].keys():
-        for poln in outDict['spw'][spwIdx].keys():
-            nptotal = outDict['spw'][spwIdx][poln]['total']
-            npflagged = outDict['spw'][spwIdx][poln]['flagged']
-            outDict['spw'][spwIdx][poln]['fraction'] = float(npflagged)/float(nptotal)
-    #
-    for antIdx in outDict['antspw'].keys():
-        for spwIdx in outDict['antspw'][antIdx].keys():
-            for poln in outDict['antspw'][antIdx][spwIdx].keys():
-                nptotal = outDict['antspw'][antIdx][spwIdx][poln]['total']
-                npflagged = outDict['antspw'][antIdx][spwIdx][poln]['flagged']
-                outDict['antspw'][antIdx][spwIdx][poln]['fraction'] = float(npflagged)/float(nptotal)
-    #
-    # do medians
-    outDict['antmedian'] = {}
-    for item in medDict.keys():
-        alist = medDict[item]
-        aarr = pl.array(alist)
-        amed = pl.median(aarr)
-        outDict['antmedian'][item] = amed
-    outDict['antmedian']['number'] = len(medDict['fraction'])
-    
+    nspw = np.max(spw)+1 if nrows > 0 else 0
+    nant = np.max(ant)+1 if nrows > 0 else 0
+    def groupsum(idx, n):
+        tot = np.bincount(idx, minlength=n)
+        flagged = np.array([np.bincount(idx, weights=frac[poln], minlength=n) for poln in range(npol)])
+        return tot, flagged
+    def stats(tot, flagged, i):
+        return dict([(poln, {'total':int(tot[i]), 'flagged':float(flagged[poln,i]), \
+            'fraction':float(flagged[poln,i])/int(tot[i])}) for poln in range(npol)])
+
+    tot, flagged = groupsum(ant*nspw+spw, nant*nspw)
+    for antIdx, spwIdx in zip(*np.nonzero(tot.reshape(nant, nspw))):
+        outDict['antspw'].setdefault(int(antIdx), {})[int(spwIdx)] = stats(tot, flagged, antIdx*nspw+spwIdx)
+
+    tot, flagged = groupsum(spw, nspw)
+    for spwIdx in np.nonzero(tot)[0]:
+        outDict['spw'][int(spwIdx)] = stats(tot, flagged, spwIdx)
+
+    tot, flagged = groupsum(ant, nant)
+    ants = np.nonzero(tot)[0]
+    for antIdx in ants:
+        outDict['ant'][int(antIdx)] = stats(tot, flagged, antIdx)
+
+    # medians over antennas (summed over pol)
+    nptotal = tot[ants]*npol
+    npflagged = np.sum(flagged[:,ants], axis=0)
+    outDict['antmedian']['total'] = np.median(nptotal)
+    outDict['antmedian']['flagged'] = np.median(npflagged)
+    outDict['antmedian']['fraction'] = np.median(npflagged/nptotal.astype(float))
+    outDict['antmedian']['number'] = len(ants)
+
     return outDict
 
 
@@ -733,8 +2240,44 @@ def gmrt_flag(ms, flagfile):
             logging.debug('Flagging antenna %s: timerange %s' % (ant, trange))
             default('flagdata')
             flagdata(vis=ms, mode='manual', spw='', antenna=ant, timerange=trange, flagbackup=False)
+    flagsChanged(ms)
     return True
 
+
+# cache of the reference antenna ranking: {key: (refAnt, geoScore, flagScore)}
+_refAntCache = {}
+
+def _dmFiles(vis, cols):
+    """Return the storage files of the data managers of "vis" holding any of "cols"
+    """
+    import glob
+    tbLoc = casac.table()
+    tbLoc.open(vis)
+    dminfo = tbLoc.getdminfo()
+    tbLoc.close()
+    files = []
+    for dm in dminfo.values():
+        if set(dm['COLUMNS']) & set(cols):
+            files += glob.glob(os.path.join(vis, 'table.f'+str(dm['SEQNR']))) + \
+                glob.glob(os.path.join(vis, 'table.f'+str(dm['SEQNR'])+'_*'))
+    return files
+
+def _flagFingerprint(vis):
+    """Return a cheap fingerprint of the flag state of an MS: size and mtime
+    of the files storing FLAG and FLAG_ROW (writing other columns does not change it)
+    """
+    files = _dmFiles(vis, ['FLAG', 'FLAG_ROW'])
+    return tuple(sorted([(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files]))
+
+def flagsChanged(vis):
+    """Invalidate everything cached about the flags of "vis",
+    to be called after any operation which changes the flags
+    """
+    vis = os.path.abspath(vis)
+    for cache in [_refAntCache, _flagSummaryCache]:
+        for key in cache.keys():
+            if key[0] == vis: del cache[key]
+
 # From the EVLA pipeline
 # Class to determine the best reference antenna
 
@@ -898,6 +2441,19 @@ class RefAntHeuristics:
         if not (self.geometry or self.flagging):
             return []
 
+        # Return the cached ranking if the MS and its flags are unchanged
+        # (the cache is invalidated by flagsChanged())
+
+        vis = os.path.abspath(self.vis)
+        key = (vis, str(self.field), str(self.spw), str(self.intent),
+               self.geometry, self.flagging,
+               os.path.getmtime(os.path.join(vis, 'ANTENNA', 'table.dat')),
+               _flagFingerprint(vis))
+        if key in _refAntCache:
+            refAnt, self.geoScore, self.flagScore = _refAntCache[key]
+            logging.debug("Refant (cached): "+str(refAnt[0]))
+            return refAnt.copy()
+
         # Get the antenna names and initialize the score dictionary
 
         names = self._get_names()
@@ -940,6 +2496,8 @@ class RefAntHeuristics:
 
         logging.debug("Refant: "+str(refAnt[0]))
 
+        _refAntCache[key] = (refAnt.copy(), self.geoScore, self.flagScore)
+
         return refAnt
 
 # ------------------------------------------------------------------------------
@@ -1013,7 +2571,11 @@ class RefAntHeuristics:
 
 # Public member variables:
 # ------------------------
-# vis - This python string contains the MS name.
+# vis      - This python string contains the MS name.
+# info     - This python dictionary contains the antenna information (see
+#            _get_info()), or None to read it from the MS.
+# measures - This python boolean selects the CASA measures path instead of the
+#            numpy one.
 
 # Public member functions:
 # ------------------------
@@ -1030,6 +2592,8 @@ class RefAntHeuristics:
 #                   antenna table of the MS.
 # _get_latlongrad - This private member function gets the latitude, longitude
 #                   and radius (from the center of the earth) for each antenna.
+# _get_latlongrad_numpy - This private member function gets the latitude,
+#                   longitude and radius for all antennas with array math.
 # _calc_distance  - This private member function calculates the antenna
 #                   distances from the array reference from the radii,
 #                   longitudes, and latitudes.
@@ -1056,7 +2620,12 @@ class RefAntGeometry:
 
 # Inputs:
 # -------
-# vis - This python string contains the MS name.
+# vis      - This python string contains the MS name.
+# info     - This python dictionary contains the antenna information in the
+#            format returned by _get_info().  If given the ANTENNA table is
+#            not read, so no CASA tool is needed.  The default is None.
+# measures - This python boolean selects the CASA measures/quanta path to get
+#            the antenna locations.  The default is False (numpy).
 
 # Outputs:
 # --------
@@ -1069,11 +2638,13 @@ class RefAntGeometry:
 
 # ------------------------------------------------------------------------------
 
-    def __init__(self, vis):
+    def __init__(self, vis, info=None, measures=False):
 
         # Set the public variables
 
         self.vis = vis
+        self.info = info
+        self.measures = measures
 
         # Return None
 
@@ -1107,9 +2678,20 @@ class RefAntGeometry:
 
         # Get the antenna information, measures, and locations
 
-        info = self._get_info()
-        measures = self._get_measures(info)
-        (radii, longs, lats) = self._get_latlongrad(info, measures)
+        if self.info is None:
+            info = self._get_info()
+        else:
+            info = self.info
+
+        # The numpy path needs cartesian (ITRF) positions, anything else
+        # goes through the measures
+
+        ref = info.get('position_keywords', {}).get('MEASINFO', {}).get('Ref', 'ITRF')
+        if self.measures or ref != 'ITRF':
+            measures = self._get_measures(info)
+            (radii, longs, lats) = self._get_latlongrad(info, measures)
+        else:
+            (radii, longs, lats) = self._get_latlongrad_numpy(info)
 
         # Calculate the antenna distances and scores
 
@@ -1276,7 +2858,7 @@ class RefAntGeometry:
 # Outputs:
 # --------
 # The python tuple containing containing radius, longitude, and latitude python
-# dictionaries, returned via the function value.
+# dictionaries, returned via the function value.  Flagged antennas are skipped.
 
 # Modification history:
 # ---------------------
@@ -1297,7 +2879,9 @@ class RefAntGeometry:
         longs = dict()
         lats = dict()
 
-        for ant in info['name']:
+        for ant, flag in zip(info['name'], info['flag_row']):
+
+            if flag or ant not in measures: continue
 
             value = measures[ant]['m2']['value']
             unit = measures[ant]['m2']['unit']
@@ -1328,6 +2912,59 @@ class RefAntGeometry:
 
 # ------------------------------------------------------------------------------
 
+# RefAntGeometry::_get_latlongrad_numpy
+
+# Description:
+# ------------
+# This private member function gets the latitude, longitude and radius (from the
+# center of the earth) for each antenna from the cartesian ITRF positions with
+# array math, without any CASA tool.
+
+# NB: The latitude is geocentric, as returned by the measures for ITRF.
+
+# Inputs:
+# -------
+# info - This python dictionary contains the antenna information from private
+#        member function _get_info().
+
+# Outputs:
+# --------
+# The python tuple containing containing radius, longitude, and latitude python
+# dictionaries, returned via the function value.  Flagged antennas are skipped.
+
+# ------------------------------------------------------------------------------
+
+    def _get_latlongrad_numpy(self, info):
+
+        # Convert the positions to m (they usually already are)
+
+        position = numpy.array(info['position'], numpy.float)
+        units = info.get('position_keywords', {}).get('QuantumUnits', ['m', 'm', 'm'])
+        toMetre = {'m': 1.0, 'km': 1.e3}
+        for i in range(3):
+            position[i] *= toMetre[units[i]]
+
+        # Get the radii, longitudes, and latitudes of all antennas at once
+
+        (x, y, z) = position
+        r = numpy.sqrt(x**2 + y**2 + z**2)
+        lon = numpy.arctan2(y, x)
+        lat = numpy.arcsin(z / r)
+
+        good = numpy.logical_not(numpy.array(info['flag_row'], bool))
+        names = numpy.array(info['name'])[good]
+
+        radii = dict(zip(names, r[good]))
+        longs = dict(zip(names, lon[good]))
+        lats = dict(zip(names, lat[good]))
+
+        # Return the tuple containing the radius, longitude, and
+        # latitude python dictionaries
+
+        return (radii, longs, lats)
+
+# ------------------------------------------------------------------------------
+
 # RefAntGeometry::_calc_distance
 
 # Description:
@@ -1384,11 +3021,7 @@ class RefAntGeometry:
         # Calculate the antenna distances from the array reference and
         # return them
 
-        distance = dict()
-        names = radii.keys()
-
-        for (i, ant) in enumerate(names):
-            distance[ant] = numpy.sqrt(pow(x[i], 2) + pow(y[i], 2))
+        distance = dict(zip(radii.keys(), numpy.sqrt(x**2 + y**2)))
 
         return distance
 
@@ -1611,31 +3244,16 @@ class RefAntFlagging:
 
     def _get_good(self):
 
-        # Create the local version of the flag tool and open the MS
-
-        fgLoc = casac.agentflagger()
-        fgLoc.open(self.vis)
-
-        # Get the flag statistics from the MS
-
-        fgLoc.selectdata( field=self.field, spw=self.spw,
-                    intent=self.intent )
-        agents = {}
-        agents['mode'] = 'summary'
-        fgLoc.parseagentparameters(agents)
-
-        fgLoc.init()
-        d = fgLoc.run()
-        fgLoc.done()
-
-        # Delete the local version of the flag tool
+        # Get the flag statistics from the MS (shared with statsFlag(),
+        # recomputed only if the flags changed)
 
-        del fgLoc
+        d = flagSummary(self.vis, field=self.field, spw=self.spw,
+                    intent=self.intent)
 
         # Calculate the number of good data for each antenna and return
         # them
 
-        antenna = d['report0']['antenna']
+        antenna = d['antenna']
         good = dict()
 
         for a in antenna.keys():